@@ -0,0 +1,92 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""SENDTO throughput of a Network with many UDP listeners.
+
+Registers N listeners (one per address, as RECVFROM does) and relays
+SENDTO messages to one of them through Network.relay_handler, with the
+(ip, port) index and, for comparison, with the scan of every listener
+that Network.lookup used to do. Usage:
+    python bench/bp_listeners.py [N ...]
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parrot.core import networking
+from parrot.core.default_backplane import bp_network
+
+# Seconds to relay for, per measurement
+DURATION = 1.0
+
+class Interface:
+    """Stands in for a bp_interface.Interface, counting what it is sent."""
+
+    def __init__(self, ip):
+        self.properties = {'ip': ip}
+        self.received = 0
+
+    def send(self, msg, flush=False):
+        self.received += 1
+
+def scan_lookup(network, ip, port):
+    """Network.lookup before the index: a scan of every listener."""
+    return [cid for cid, listener in network.listeners.iteritems()
+            if listener['ip'] == ip and listener['port'] == port]
+
+def address(i):
+    return '10.%d.%d.%d' % (i >> 16, (i >> 8) & 255, i & 255)
+
+def network_with_listeners(count, codec):
+    network = bp_network.Network('urn:hodcp:network:bench', {}, codec)
+    for i in range(count):
+        msg = codec.build_message(networking.RECVFROM, id=i + 1, ip=address(i), port=4321)
+        network.relay_handler(memoryview(msg), Interface(address(i)))
+    return network
+
+def sendto_rate(network, codec):
+    """SENDTO messages relayed per second."""
+    # Comm channels pass frames on as views of their receive buffer
+    msg = memoryview(codec.build_message(networking.SENDTO, id=0, src_port=1000,
+                                         dst_ip=address(len(network.listeners) // 2), dst_port=4321, payload='hello'))
+    source = Interface('10.255.0.1')
+    relay = network.relay_handler
+    count = 0
+    batch = 10
+    start = time.time()
+    while time.time() - start < DURATION:
+        for i in xrange(batch):
+            relay(msg, source)
+        count += batch
+        # Keep the slow cases from overshooting the duration by much
+        batch = min(batch * 2, 10000)
+    return count / (time.time() - start)
+
+def main(counts):
+    codec = networking.TEXT
+    print '%10s %14s %14s' % ('listeners', 'index', 'scan')
+    for count in counts:
+        network = network_with_listeners(count, codec)
+        indexed = sendto_rate(network, codec)
+        network.lookup = lambda ip, port: scan_lookup(network, ip, port)
+        scanned = sendto_rate(network, codec)
+        print '%10d %12.0f/s %12.0f/s' % (count, indexed, scanned)
+
+if __name__ == '__main__':
+    main([int(arg) for arg in sys.argv[1:]] or [10, 1000, 10000, 100000])
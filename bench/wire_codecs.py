@@ -0,0 +1,62 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""Encode and decode rates of the TEXT and BINARY wire protocols.
+
+Builds and parses a few typical messages with each codec, taking the
+best of several timeit runs. Usage:
+    python bench/wire_codecs.py [N]
+where N is the number of messages per run (default 50000).
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parrot.core import networking
+
+# Runs per measurement, the fastest one counts
+REPEAT = 7
+
+def cases():
+    """(name, op, params) of the messages to measure."""
+    return [
+        ('SEND 1KB', networking.SEND, dict(id=0x1234567890abcdef, payload='x' * 1024)),
+        ('SEND 64KB', networking.SEND, dict(id=0x1234567890abcdef, payload='x' * 65536)),
+        ('CONNECT', networking.CONNECT, dict(id=0x1234567890abcdef, ip='10.1.2.3', port=8080)),
+        ('SENDTO 64B', networking.SENDTO, dict(id=0x1234567890abcdef, src_port=4000, dst_ip='10.1.2.3',
+                                              dst_port=53, payload='x' * 64)),
+    ]
+
+def rate(func, count):
+    """Calls of func per second."""
+    return count / min(timeit.repeat(func, number=count, repeat=REPEAT))
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    print '%-7s %-11s %6s %12s %12s' % ('codec', 'message', 'bytes', 'encode/s', 'decode/s')
+    for codec in (networking.TEXT, networking.BINARY):
+        for name, op, params in cases():
+            # Messages arrive as a view of the receive buffer
+            msg = memoryview(bytearray(codec.build_message(op, **params)))
+            encode = rate(lambda: codec.build_message(op, **params), count)
+            decode = rate(lambda: codec.parse_message(msg), count)
+            print '%-7s %-11s %6d %12.0f %12.0f' % (codec.name, name, len(msg), encode, decode)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,233 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""Fuzzing and speed of the incremental websocket frame parser.
+
+Builds random streams of client frames: masked or not, with 7, 16 and
+64 bit lengths, messages in fragments with control frames in between,
+and, for some, corrupted bytes. Each stream is fed to wsclient in one
+read and then in random splits (down to single bytes, so that headers,
+masks and payloads are split across reads). Both must give the same
+messages and the same error, and the messages of a valid stream must be
+the ones it was built from. Then the parse rate is measured. Usage:
+    python bench/ws_frames.py [streams [seed]]
+"""
+
+import errno
+import os
+import random
+import socket
+import struct
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from parrot.core import web_socket
+
+# Payload sizes around the length encoding limits
+SIZES = [0, 1, 2, 125, 126, 127, 1000, 65535, 65536, 70000]
+# Sizes of the reads a stream is split into
+READS = [1, 2, 3, 4, 5, 7, 10, 14, 100, 4096, 65536]
+
+class FeedSocket:
+    """Stands in for the socket of a wsclient, recv returns what was fed."""
+
+    def __init__(self):
+        self.data = ''
+        self.closed = False
+        self.sent = []
+
+    def setblocking(self, flag):
+        pass
+
+    def recv(self, size):
+        if not self.data:
+            if self.closed:
+                return ''
+            raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+        chunk, self.data = self.data[:size], self.data[size:]
+        return chunk
+
+    def send(self, data):
+        self.sent.append(str(data))
+        return len(data)
+
+    def close(self):
+        pass
+
+def random_bytes(rnd, count):
+    """Bytes drawn from rnd, so that a seed reproduces a stream."""
+    return ''.join(chr(rnd.getrandbits(8)) for _ in xrange(count))
+
+def mask_bytes(key, data):
+    """Reference masking, byte by byte."""
+    key = map(ord, key)
+    return ''.join(chr(ord(c) ^ key[i % 4]) for i, c in enumerate(data))
+
+def frame(rnd, opcode, payload, fin=True, masked=True):
+    """A client frame, the length encoded in any of the ways allowed."""
+    header = chr((0x80 if fin else 0) | opcode)
+    length = len(payload)
+    mask_bit = 0x80 if masked else 0
+    if length <= 125 and rnd.random() < 0.7:
+        header += chr(mask_bit | length)
+    elif length <= 0xffff and rnd.random() < 0.7:
+        header += chr(mask_bit | 126) + struct.pack('!H', length)
+    else:
+        header += chr(mask_bit | 127) + struct.pack('!Q', length)
+    if not masked:
+        return header + payload
+    key = random_bytes(rnd, 4)
+    return header + key + mask_bytes(key, payload)
+
+def random_text(rnd):
+    size = rnd.choice(SIZES)
+    if rnd.random() < 0.5:
+        return u'x' * size
+    chars = [u'a', u'\xe5', u'\u20ac', u'\U0001f600']
+    return u''.join(rnd.choice(chars) for _ in range(size // 4))
+
+def random_stream(rnd):
+    """Return a stream of frames and the messages it carries."""
+    stream = []
+    messages = []
+    masked = rnd.random() < 0.9
+    for _ in range(rnd.randint(1, 8)):
+        binary = rnd.random() < 0.3
+        if binary:
+            message = random_bytes(rnd, rnd.choice(SIZES))
+            data = message
+        else:
+            message = random_text(rnd)
+            data = message.encode('utf-8')
+        messages.append(message)
+        # Fragments, cut anywhere (also inside UTF-8 sequences), with pings between them
+        cuts = sorted(rnd.randint(0, len(data)) for _ in range(rnd.randint(0, 3)))
+        pieces = [data[start:end] for start, end in zip([0] + cuts, cuts + [len(data)])]
+        for index, piece in enumerate(pieces):
+            if index:
+                opcode = web_socket.OPCODE_CONTINUATION
+            else:
+                opcode = web_socket.OPCODE_BINARY if binary else web_socket.OPCODE_TEXT
+            stream.append(frame(rnd, opcode, piece, index == len(pieces) - 1, masked))
+            if rnd.random() < 0.3:
+                control = rnd.choice([web_socket.OPCODE_PING, web_socket.OPCODE_PONG])
+                stream.append(frame(rnd, control, random_bytes(rnd, rnd.randint(0, 125)), True, masked))
+    if rnd.random() < 0.3:
+        stream.append(frame(rnd, web_socket.OPCODE_CLOSE, struct.pack('!H', 1000), True, masked))
+        messages.append(None)
+    return ''.join(stream), messages
+
+def corrupt(rnd, stream):
+    """Flip, insert or cut bytes of stream."""
+    stream = bytearray(stream)
+    for _ in range(rnd.randint(1, 3)):
+        pos = rnd.randint(0, len(stream))
+        what = rnd.random()
+        if what < 0.5 and pos < len(stream):
+            stream[pos] ^= 1 << rnd.randint(0, 7)
+        elif what < 0.8:
+            stream[pos:pos] = random_bytes(rnd, rnd.randint(1, 12))
+        else:
+            del stream[pos:]
+    return str(stream)
+
+def parse(stream, reads):
+    """Feed stream to a wsclient in reads of the given sizes and then close
+    it. Return the messages and the class of the error raised, if any."""
+    sock = FeedSocket()
+    ws = web_socket.wsclient(sock)
+    messages = []
+    pos = 0
+    for size in reads + [len(stream)]:
+        sock.data += stream[pos:pos + size]
+        pos += size
+        if pos >= len(stream):
+            sock.closed = True
+        try:
+            messages += ws.receive_messages()
+        except (web_socket.ConnectionTerminatedException, web_socket.UnsupportedFrameException,
+                web_socket.BadOperationException), e:
+            return messages, e.__class__
+        if messages and messages[-1] is None:
+            break
+    return messages, None
+
+def random_reads(rnd, length):
+    reads = []
+    while sum(reads) < length:
+        reads.append(rnd.choice(READS))
+    return reads
+
+def fuzz(count, rnd):
+    errors = 0
+    for index in range(count):
+        stream, expected = random_stream(rnd)
+        broken = rnd.random() < 0.4
+        if broken:
+            stream = corrupt(rnd, stream)
+        once = parse(stream, [])
+        split = parse(stream, random_reads(rnd, len(stream)))
+        bytewise = parse(stream, [1] * len(stream)) if len(stream) < 3000 else split
+        if not broken:
+            if expected[-1] is not None:
+                expected = expected + [None]
+            assert once == (expected, None), 'stream %d: one read gave %s' % (index, once[1])
+        # An error loses the messages completed by the same read, so only the
+        # messages of earlier reads are certain
+        for result in (split, bytewise):
+            assert result[1] == once[1], 'stream %d: %s in one read, %s split' % (index, once[1], result[1])
+            if once[1] is None:
+                assert result[0] == once[0], 'stream %d: messages differ' % index
+        if once[1]:
+            errors += 1
+    print 'fuzz: %d streams, %d rejected, all reads agree' % (count, errors)
+
+def rate(stream, reads, messages):
+    """Messages parsed per second, with the stream fed in reads."""
+    sock = FeedSocket()
+    ws = web_socket.wsclient(sock)
+    chunks = [stream[pos:pos + reads] for pos in range(0, len(stream), reads)]
+    got = 0
+    start = time.time()
+    for chunk in chunks:
+        sock.data = chunk
+        got += len(ws.receive_messages())
+    elapsed = time.time() - start
+    assert got == messages
+    return messages / elapsed, len(stream) / elapsed / 1e6
+
+def bench(rnd):
+    small = '{"dest": "urn:hodcp:node:1", "sender": "urn:weblink", "action": "set", "key": "temp", "value": 21.5}'
+    count = 50000
+    stream = ''.join(frame(rnd, web_socket.OPCODE_TEXT, small) for _ in range(count))
+    for reads in (65536, 1000, len(stream) // count):
+        print 'bench: %d small messages in %6d byte reads %8.0f msgs/s %6.1f MB/s' % ((count, reads) + rate(stream, reads, count))
+    large = 'x' * (4 << 20)
+    key = random_bytes(rnd, 4)
+    stream = chr(0x81) + chr(0xff) + struct.pack('!Q', len(large)) + key + web_socket.RepeatedXorMasker(key).mask(large)
+    for reads in (65536, 4096):
+        print 'bench: one 4 MB message in %6d byte reads %6.1f MB/s' % (reads, rate(stream, reads, 1)[1])
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 500
+    rnd = random.Random(int(sys.argv[2]) if len(sys.argv) > 2 else 1)
+    fuzz(count, rnd)
+    bench(rnd)
+
+if __name__ == '__main__':
+    main()
@@ -14,11 +14,15 @@
 #
 ########################################################################
 
-import socket
-import select
+import time
 import uuid
 import binascii
+import accessors
 import comm_chan
+import log_limits
+import networking
+import poller
+import federation
 import default_backplane.bp_network as bp_network
 import default_backplane.bp_node as bp_node
 import default_backplane.bp_serial as bp_serial
@@ -26,19 +30,28 @@ import default_backplane.bp_interface as bp_interface
 
 class Backplane:
 
-    from accessors import configure, get, set
+    from accessors import configure
     
-    def __init__(self, port, config, ctrl):
+    def __init__(self, transport, config, ctrl):
         self.urn = 'urn:backplane'
         self.config = config
-        self.server_port = port
+        self.transport = transport
         self.conn = None  # No use of conn until server is up and running.
         self.__ctrl = ctrl     # Store ctrl channel here until free for all to use.
         self.links = None
+        self.codec = networking.get_codec(config.get('wire_protocol', 'text'))
+        # A shard config is restricted to some nodes, but carries the namespaces of the whole simulation
+        self.id_namespaces = config.get('id_namespaces') or networking.id_namespaces(config)
         self.networks = {}
         self.nodes = {}
+        self.pending_flush = set()   # Comm channels with queued frames
+        self.inputs = poller.Poller()
+        self.federation = None
+        self.peers = {}              # Host -> federation.PeerLink
         self.state = {'capabilities': { 'logging': { 'type': 'boolean' }}}
         self.state.update({'logging':False})
+        self.log_limiter = log_limits.LogLimiter()
+        self.set_log_limits(config.get('log_limits'))
 
         self.weblink_update = True
 
@@ -56,37 +69,89 @@ class Backplane:
             urn = sender.urn()
         else:
             urn = self.urn
+        if not self.log_limiter.allow(urn):
+            return
 
         msg = binascii.b2a_qp(data)
             
         print "[%s] %s" % (urn, msg)
-        request = {'dest':'urn:hodcp:core', 'sender':urn, 'action':'set', 'key':'log', 'value':msg}
+        request = {'dest':'urn:logger', 'sender':urn, 'action':'set', 'key':'log', 'value':msg}
         self.conn.send(request)
 
+    def set(self, key, value, sender=None):
+        if key == 'log_limits':
+            self.set_log_limits(value)
+            return
+        accessors.set(self, key, value, sender)
+        if key == 'logging':
+            # Cut-through traffic would not be logged
+            for nw in self.networks.values():
+                nw.cut_through = not self.state['logging']
+
+    def get(self, key):
+        if key in log_limits.KEYS:
+            return self.log_limiter.get(key)
+        return accessors.get(self, key)
+
+    def set_log_limits(self, config):
+        """Rate limits and sampling of the traffic log, see log_limits.py"""
+        try:
+            self.log_limiter.configure(config)
+        except ValueError, e:
+            print "[Backplane] %s" % e
+
+    def log_remote(self, data, sender=None):
+        """Traffic of nodes on other hosts is logged there."""
+        pass
+
     def setup(self):
+        if 'federation' in self.config:
+            self.federation = federation.Federation(self.config)
+        fed = self.federation
         # Create networks
         for network_urn, network_config in self.config.get('networks', {}).iteritems():
-            self.networks[network_urn] = bp_network.Network(network_urn, network_config)
+            if fed and fed.owner_of.get(network_urn) != fed.host:
+                continue
+            ids = networking.IdSpace(self.id_namespaces[network_urn])
+            self.networks[network_urn] = bp_network.Network(network_urn, network_config, self.codec, ids)
         # Create serial link handler
         self.links = bp_serial.Serial(self.config.get('links', {}))
-        # Create nodes and interfaces
+        # Create nodes and interfaces. When federated, nodes on other hosts
+        # are only needed if attached to a network or link owned by this host.
         for node_urn, node_config in self.config['nodes'].iteritems():
             node = bp_node.Node(node_urn, node_config)
+            local = not fed or fed.is_local(node_urn)
+            needed = local
             for if_name, if_conf in node_config['interfaces'].iteritems():
                 interface = bp_interface.Interface(if_name, if_conf, node)
                 node.interfaces[if_name] = interface
-                if if_name[0:3] == 'eth':
+                owner = fed and fed.owner(node_urn, if_name, if_conf)
+                if owner and owner != fed.host:
+                    # Relayed by the backplane of another host
+                    interface.relay_handler = self.peer_link(owner).relay_handler
+                elif if_name[0:3] == 'eth':
                     nw = self.networks[if_conf['network']]
                     interface.relay_handler = nw.relay_handler
+                    needed = True
                 elif if_name[0:3] == 'ser':
                     interface.relay_handler = self.links.relay_handler
+                    needed = True
+                if not local:
+                    interface.log = self.log_remote
+                    continue
                 interface.log = self.log
                 if_urn = interface.urn() 
                 self.state['capabilities'].update({if_urn:{'type': 'boolean'}})
                 self.state.update({if_urn:False})
+            if not needed:
+                continue
+            if not local:
+                node.cc = federation.RemoteChannel(self.peer_link(fed.host_of[node_urn]), node_urn)
             self.nodes[node_urn] = node
         # Map serial links
         for src, dst in self.config.get('links', {}).iteritems():
+            if fed and fed.owner_of[src] != fed.host:
+                continue
             src_urn, _, src_if_name = src.rpartition(':')
             src_if = self.nodes[src_urn].interfaces[src_if_name]
             dst_urn, _, dst_if_name = dst.rpartition(':')
@@ -128,16 +193,47 @@ class Backplane:
         urn = sender.handshake(data, self)
         bp_node = self.nodes[urn]
         bp_node.cc = sender
+
+    def peer_link(self, host):
+        """Return the link to the backplane of another host."""
+        link = self.peers.get(host)
+        if not link:
+            host_config = self.federation.hosts[host]
+            link = federation.PeerLink(host, host_config['address'], host_config['port'], self.inputs)
+            link.write_pending = self.pending_flush.add
+            self.peers[host] = link
+        return link
+
+    def handle_peer_relay(self, data, sender):
+        urn, data = federation.split_frame(data)
+        self.nodes[urn].relay(data)
+
+    def handle_peer_deliver(self, data, sender):
+        urn, data = federation.split_frame(data)
+        interface = self.nodes[urn].interfaces[data[0:4].tobytes()]
+        interface.send(data[4:])
+
+    def create_peer_channel(self, sock):
+        pc = federation.PeerLinkBack(sock)
+        pc.register_handler_for_interface(federation.RELAY, self.handle_peer_relay)
+        pc.register_handler_for_interface(federation.DELIVER, self.handle_peer_deliver)
+        return pc
+
+    def create_comm_channel(self, sock):
+        cc = comm_chan.CommChanBack(sock)
+        cc.codec = self.codec
+        cc.id_namespaces = self.id_namespaces
+        cc.coalesce = True
+        cc.write_pending = self.pending_flush.add
+        cc.register_handler_for_interface(cc.name, self.handle_handshake)
+        cc.default_handler = self.handle_recv
+        return cc
         
     def serve(self):
-        host = ''
-        backlog = 5
-        size = 512
-
-        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        server.bind((host, self.server_port))
-        server.listen(backlog)
+        server = self.transport.listen()
+        peer_server = None
+        if self.federation:
+            peer_server = self.federation.listen()
 
         # Acknowledge to core that server is up:
         ack = {'dest':'urn:hodcp:core', 'sender':self.urn, 'action':'ACK', 'key':"backplane running", 'value': 'OK'}
@@ -148,22 +244,32 @@ class Backplane:
         self.log("Started.")
         # Track input sources
         ctrl = self.conn
-        inputs = [ctrl, server]
+        inputs = self.inputs
+        inputs.register(ctrl)
+        if server:
+            inputs.register(server)
+        if peer_server:
+            inputs.register(peer_server)
+        for sock in self.transport.channels():
+            inputs.register(self.create_comm_channel(sock))
 
         running = True
         while running:
-            inputready, _, _ = select.select(inputs,[],[])
-
-            for s in inputready:
+            for s, events in inputs.poll(self.peer_timeout()):
 
                 if s == server:
                     # handle the server socket
-                    client, address = server.accept()
-                    # print "[Backplane] Accepted:", (client, address)
-                    cc = comm_chan.CommChanBack(client)
-                    cc.register_handler_for_interface(cc.name, self.handle_handshake)
-                    cc.default_handler = self.handle_recv
-                    inputs.append(cc)
+                    client = self.transport.accept(server)
+                    # print "[Backplane] Accepted:", client
+                    inputs.register(self.create_comm_channel(client))
+
+                elif s == peer_server:
+                    # another host connecting its peer link
+                    sock, address = peer_server.accept()
+                    inputs.register(self.create_peer_channel(sock))
+
+                elif isinstance(s, federation.PeerLink):
+                    s.handle_event(events)
 
                 elif s == ctrl:
                     msg = s.recv()
@@ -180,8 +286,32 @@ class Backplane:
 
                 else:
                     # handle all other (comm_chan.EndPoint)
-                    s.recv_cmd()
-
+                    if not s.recv_cmd():
+                        inputs.unregister(s)
+                        self.pending_flush.discard(s)
+                        self.closed_comm_channel(s)
+                    elif s.input_pending():
+                        inputs.ready(s)
+
+            # Peer links connecting, or waiting to try again
+            if self.peers:
+                now = time.time()
+                for link in self.peers.itervalues():
+                    link.check(now)
+
+            # Send everything relayed during this iteration
+            self.flush()
+
+    def peer_timeout(self):
+        """Seconds the poll may block for the sake of the peer links, None for ever."""
+        now = time.time()
+        timeouts = [t for t in (link.timeout(now) for link in self.peers.itervalues()) if t is not None]
+        return min(timeouts) if timeouts else None
+
+    def flush(self):
+        """Send frames queued on comm channels, one write per channel."""
+        while self.pending_flush:
+            self.pending_flush.pop().flush()
 
     def parse_control(self, msg):
         if msg['action'] == 'set' and msg['key'] == 'running':
@@ -190,8 +320,8 @@ class Backplane:
             running = self.handle_control_message(msg)
         return running
         
-def create_backplane(port, config, ctrl):
-    bp = Backplane(port, config, ctrl)
+def create_backplane(transport, config, ctrl):
+    bp = Backplane(transport, config, ctrl)
     bp.serve()
 
 
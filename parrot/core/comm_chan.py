@@ -14,23 +14,47 @@
 #
 ########################################################################
 
+import os
+import errno
+import fcntl
+import mmap
+import select
 import socket
+import struct
 import threading
+import networking
 
-def recv_socket_fixed_size(sock, sz):
-    "Receive a fixed number of bytes from the socket"
-    buf = ""
-    received = 0
-    while received < sz:
-        buf += sock.recv(sz - received)
-        received = len(buf)
-    return buf
-
-def recv_socket_msg(sock):
-    "Receive a message (with an embedded size) from the socket"
-    sz_str   = recv_socket_fixed_size(sock, 4)
-    data_str = recv_socket_fixed_size(sock, int(sz_str))
-    return sz_str + data_str
+# Framings supported on the comm channel. The 'text' framing prefixes each
+# frame with its length as a 4-character decimal string, which limits a frame
+# to 9999 bytes. The 'binary' framing uses a fixed-width header holding the
+# payload length, the interface tag and a message type. The framing is chosen
+# by the node and confirmed by the backplane during the handshake, which is
+# itself always sent using the 'text' framing.
+FRAMING_TEXT = 'text'
+FRAMING_BINARY = 'binary'
+FRAMINGS = (FRAMING_TEXT, FRAMING_BINARY)
+DEFAULT_FRAMING = FRAMING_BINARY
+
+# Message types carried in the binary header
+MSG_DATA = 0        # Interface traffic
+MSG_CHAN = 1        # Comm channel housekeeping (handshake)
+
+# <length[4]><type[1]><if[4]>, length excludes the header itself
+_binary_header = struct.Struct('!IB4s')
+_BINARY_TAG_OFFSET = 5
+
+TEXT_MAX_FRAME = 9999
+
+# Initial size of the receive buffer, it grows to fit the largest frame seen
+RECV_BUFFER_SIZE = 65536
+# Queued outgoing bytes that force a flush when coalescing
+WRITE_HIGH_WATER = 262144
+# Buffers filled by one recv_cmd() at most, so one busy channel can't starve
+# the others, see EndPoint.input_pending()
+RECV_FILLS = 16
+
+# Backplane socket of the unix transport unless a path is given (%d is the Core pid)
+DEFAULT_UNIX_PATH = '/tmp/parrot-backplane-%d.sock'
 
 class EndPoint:
     """
@@ -48,6 +72,24 @@ class EndPoint:
         self.interfaces = {}
         self.name = 'cchn'
         self.option_raw = False
+        self.framing = FRAMING_TEXT
+        # Encoding of socket messages and the ids of the sockets opened over
+        # this channel, both given by the backplane in the handshake
+        self.codec = networking.TEXT
+        self.ids = networking.IdSpace(0)
+        # Receive buffer, holds bytes [_rstart:_rend] not yet parsed into frames
+        self._rbuf = bytearray(RECV_BUFFER_SIZE)
+        self._rview = memoryview(self._rbuf)
+        self._rstart = 0
+        self._rend = 0
+        # Frames queued by send_cmd, sent by flush()
+        self._wbuf = bytearray()
+        self._wlock = threading.Lock()
+        # When coalescing, frames are held until flush() is called (or the
+        # queue grows past WRITE_HIGH_WATER), and write_pending (if set) is
+        # called with the endpoint when the first frame is queued.
+        self.coalesce = False
+        self.write_pending = None
                 
     def fileno(self):
         return self._socket.fileno()        
@@ -66,63 +108,189 @@ class EndPoint:
         return interface_name in self.interfaces
 
     def default_handler(self, data, sender):
-        if data[0:7]=='DISCONN':
+        if self.codec.message_op(data) == networking.DISCONN:
             # This is OK
             return
-        
-        self.available_cond.release()
+
         print self
-        print data
+        print data.tobytes()
         raise Exception("[%s] Comm channel interface handler not registered" % (self.urn))
             
     def recv_cmd(self):
         """
-        Should receive string of format: <length[4]><if[4]><data[N]>
-        and pass <data[N]> on to correct interface.
+        Receive as much as is available from the socket and pass every complete
+        frame on to the correct interface.
+
+        Frames have the format <length[4]><if[4]><data[N]> (or
+        <length[4]><type[1]><if[4]><data[N]> using binary framing).
+        Handlers are passed a memoryview of <data[N]> (or <if[4]><data[N]> if
+        option_raw is set) which is only valid until the handler returns, a
+        handler that keeps the data must copy it.
+        Return False if the peer has closed the channel.
         """
         self.available_cond.acquire()
-        msg = recv_socket_msg(self._socket)
+        try:
+            received = self._fill_buffer()
+            if received:
+                self._parse_frames()
+                # Sockets without level triggered readiness (shm) may hold more
+                # than fit in the buffer, with no wakeup left to poll for
+                fills = 1
+                while fills < RECV_FILLS and self.input_pending():
+                    self._fill_buffer()
+                    self._parse_frames()
+                    fills += 1
+                self.available_cond.notify()
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                raise
+            # Spurious wakeup, nothing to read
+            received = -1
+        finally:
+            self.available_cond.release()
+        return received != 0
 
-        # FIXME: Split off this inner part
-        if_name = msg[4:8]
-        if self.option_raw:
-            data = msg[4:]
-        else:
-            data = msg[8:]
-        if if_name[0:3] == 'eth':
-            # We need socket id to find mapping
-            parts = data.split(' ', 2)
-            if_name = parts[1]
+    def _fill_buffer(self):
+        if self._rend == len(self._rbuf):
+            pending = self._rend - self._rstart
+            if self._rstart > 0:
+                # Move the incomplete frame to the start of the buffer
+                self._rbuf[0:pending] = self._rbuf[self._rstart:self._rend]
+            else:
+                # Incomplete frame fills the buffer, grow it
+                rbuf = bytearray(2 * len(self._rbuf))
+                rbuf[0:pending] = self._rbuf[0:pending]
+                self._rbuf = rbuf
+                self._rview = memoryview(rbuf)
+            self._rstart = 0
+            self._rend = pending
+        received = self._socket.recv_into(self._rview[self._rend:])
+        self._rend += received
+        return received
+
+    def input_pending(self):
+        """Tell if the socket holds more that no wakeup will be polled for,
+        i.e. the channel is to be treated as readable, see Poller.ready()."""
+        pending = getattr(self._socket, 'pending', None)
+        return pending is not None and pending() > 0
+
+    def _parse_frames(self):
+        rbuf, rview = self._rbuf, self._rview
+        start, end = self._rstart, self._rend
+        while True:
+            if self.framing == FRAMING_BINARY:
+                if end - start < _binary_header.size:
+                    break
+                size, msg_type, if_name = _binary_header.unpack_from(rbuf, start)
+                tag = start + _BINARY_TAG_OFFSET
+                frame_end = start + _binary_header.size + size
+            else:
+                if end - start < 4:
+                    break
+                tag = start + 4
+                frame_end = tag + int(str(rbuf[start:tag]))
+                if_name = str(rbuf[tag:tag + 4])
+            if frame_end > end:
+                break
+            if self.option_raw:
+                data = rview[tag:frame_end]
+            else:
+                data = rview[tag + 4:frame_end]
+            if if_name[0:3] == 'eth':
+                # We need socket id to find mapping
+                if_name = self.codec.message_id(rbuf, tag + 4, frame_end)
+            start = frame_end
+            # Handlers may switch framing (handshake), so store progress first
+            self._rstart = start
+            self.dispatch(if_name, data)
+        if start == end:
+            start = end = 0
+        self._rstart, self._rend = start, end
+
+    def dispatch(self, if_name, data):
+        """Pass data to the handler of if_name."""
         iface_handler = self.interfaces.get(if_name, self.default_handler)
         iface_handler(data, self)
-        
-        self.available_cond.notify()
-        self.available_cond.release()
 
-    def send_cmd(self, msg, sender):
-        msg = bytearray(sender.name, 'utf-8') + bytearray(msg)
-        size_str = "%4d" % len(msg)
-        # print "Sending: %s" % size_str + msg
-        self._socket.send(size_str + msg)
+    def send_cmd(self, msg, sender, msg_type=MSG_DATA, flush=False, prefix=''):
+        """
+        Queue msg as a frame from sender (an interface). Unless coalescing is
+        enabled, or flush is requested, the frame is sent right away.
+        A prefix is sent in front of msg, sparing the caller a copy to join them.
+        """
+        if self.framing == FRAMING_BINARY:
+            header = _binary_header.pack(len(prefix) + len(msg), msg_type, str(sender.name))
+        else:
+            name = str(sender.name)
+            size = len(name) + len(prefix) + len(msg)
+            if size > TEXT_MAX_FRAME:
+                raise ValueError("[%s] Frame of %d bytes too large for text framing" % (self.urn, size))
+            header = "%4d%s" % (size, name)
+        self._wlock.acquire()
+        try:
+            schedule = not self._wbuf
+            self._wbuf += header
+            if prefix:
+                self._wbuf += prefix
+            self._wbuf += msg
+            if flush or not self.coalesce or len(self._wbuf) >= WRITE_HIGH_WATER:
+                self._flush()
+            elif schedule and self.write_pending:
+                self.write_pending(self)
+        finally:
+            self._wlock.release()
+
+    def flush(self):
+        """Send all queued frames in one go."""
+        self._wlock.acquire()
+        try:
+            self._flush()
+        finally:
+            self._wlock.release()
+
+    def _flush(self):
+        if self._wbuf:
+            # print "Sending: %s" % self._wbuf
+            self._socket.sendall(self._wbuf)
+            self._wbuf = bytearray()
+
+    def close(self):
+        if self._socket:
+            self.flush()
+            self._socket.close()
+            self._socket = None
 
 class CommChan(EndPoint):
-    def __init__(self, host, port, urn):
+    def __init__(self, transport, urn, framing=DEFAULT_FRAMING):
         EndPoint.__init__(self)
-    
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.connect((host, port)) # FIXME: Handle failure gracefully
-        self._socket = sock
+
+        self._socket = transport.connect(urn) # FIXME: Handle failure gracefully
         self.urn = urn 
-        # Initialize handshake
+        # Initialize handshake, offering our preferred framing
         self.register_handler_for_interface(self.name, self.finalize_handshake)
-        self.send_cmd(bytearray(self.urn, 'utf-8'), self)
+        self.send_cmd(bytearray('%s %s' % (self.urn, framing), 'utf-8'), self, MSG_CHAN)
+        # Wait for the reply, nothing else may be sent until the framing is settled
+        while self.has_registered_handler(self.name):
+            if not self.input_pending():
+                select.select([self], [], [])
+            if not self.recv_cmd():
+                break
         
     def finalize_handshake(self, reply, sender):
-        if not reply == 'OK':
+        # OK [<framing> [<wire protocol> <id namespace>]]
+        status, _, framing = reply.tobytes().partition(' ')
+        framing, _, wire_protocol = framing.partition(' ')
+        wire_protocol, _, namespace = wire_protocol.partition(' ')
+        if not status == 'OK':
             print '[CommChan] Error connecting "%s" to backplane' % self.urn
             self._socket.close()
             self._socket = None
+        elif framing in FRAMINGS:
+            self.framing = framing
+            if wire_protocol:
+                self.codec = networking.get_codec(wire_protocol)
+            if namespace:
+                self.ids = networking.IdSpace(int(namespace))
         self.unregister_handler_for_interface(self.name)
 
 class CommChanBack(EndPoint):
@@ -130,23 +298,358 @@ class CommChanBack(EndPoint):
         EndPoint.__init__(self)
         self._socket = sock
         self.option_raw = option_raw
+        # Node urn -> id namespace, see networking.id_namespaces()
+        self.id_namespaces = {}
         
     def handshake(self, data, sender):
         """The magical procedure by which the client establishes
         a relation with the backplane. Thus it maps a node urn to a socket.
         N.B. This is the node URN, not the interface URN, see setup_serial_link.
+        The node may append its preferred framing, separated by a space,
+        and the reply then also tells the wire protocol (codec) in use and
+        the namespace of the ids the node mints.
         Return URN on success. """
 
         if self.option_raw:
-            urn = data[4:]
+            urn = data[4:].tobytes()
         else:
-            urn = data
+            urn = data.tobytes()
+        urn, _, framing = urn.partition(' ')
         if urn[:4] == 'urn:':
             self.urn = urn
-            self.send_cmd(bytearray('OK', 'utf-8'), self)
+            if framing in FRAMINGS:
+                # Confirm framing, then switch to it
+                reply = 'OK %s %s %d' % (framing, self.codec.name, self.id_namespaces.get(urn, 0))
+                self.send_cmd(bytearray(reply, 'utf-8'), self, MSG_CHAN)
+                self.framing = framing
+            else:
+                self.send_cmd(bytearray('OK', 'utf-8'), self, MSG_CHAN)
         else:
             print "Not setting URN: '%s'" % urn
+            self.send_cmd(bytearray('ERROR', 'utf-8'), self, MSG_CHAN)
             urn = None
 
         self.unregister_handler_for_interface(self.name)
         return urn
+
+# ----------------------------------------------------------------------------------
+# Transports, i.e. how the comm channel of a node reaches the backplane.
+#
+# The transport is created by the Core before the backplane and the nodes are
+# started, and is passed on to each of them. The backplane calls listen() and
+# accept() to get channels from nodes connecting to it, and channels() to get
+# channels connected before it was started. A node calls connect().
+# Once a process has been started, the Core calls release() to close
+# descriptors that only the started process needs.
+# ----------------------------------------------------------------------------------
+
+class Transport:
+
+    def listen(self):
+        """Return a listening socket to be polled by the backplane, or None."""
+        return None
+
+    def accept(self, server):
+        """Return the socket of a node connecting to server."""
+        sock, address = server.accept()
+        return sock
+
+    def channels(self):
+        """Return the sockets of nodes already connected to the backplane."""
+        return []
+
+    def connect(self, urn):
+        """Return a socket connected to the backplane for node urn."""
+        raise NotImplementedError
+
+    def release(self, urn=None):
+        """Called in the Core once the backplane (urn is None) or node urn is started."""
+        pass
+
+class TcpTransport(Transport):
+    def __init__(self, host='', port=1111, backlog=5):
+        self.host = host
+        self.port = port
+        self.backlog = backlog
+
+    def listen(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((self.host, self.port))
+        server.listen(self.backlog)
+        return server
+
+    def connect(self, urn):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.connect((self.host, self.port))
+        return sock
+
+class UnixTransport(Transport):
+    def __init__(self, path, backlog=5):
+        self.path = path
+        self.backlog = backlog
+
+    def listen(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(self.backlog)
+        return server
+
+    def connect(self, urn):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        return sock
+
+class SocketPairTransport(Transport):
+    """One socketpair per node, created before the backplane and nodes are started
+    and inherited by them. There is no listening socket and thus no fixed port,
+    and no race between nodes connecting and the backplane accepting."""
+
+    def __init__(self, urns):
+        # urn -> (backplane end, node end)
+        self.pairs = dict((urn, socket.socketpair()) for urn in urns)
+
+    def channels(self):
+        for urn, (bp_sock, node_sock) in self.pairs.iteritems():
+            node_sock.close()
+        return [bp_sock for bp_sock, node_sock in self.pairs.values()]
+
+    def connect(self, urn):
+        # Close what the node inherited from the Core, except our own end
+        for other, (bp_sock, node_sock) in self.pairs.iteritems():
+            bp_sock.close()
+            if other != urn:
+                node_sock.close()
+        return self.pairs[urn][1]
+
+    def release(self, urn=None):
+        if urn is None:
+            for bp_sock, node_sock in self.pairs.values():
+                bp_sock.close()
+        else:
+            self.pairs[urn][1].close()
+
+# Shared memory ring layout: producer counter and flag, consumer counter (on
+# separate cache lines) and then the data
+_ring_counter = struct.Struct('Q')
+_RING_HEAD = 0
+_RING_WAITING = 8
+_RING_TAIL = 64
+_RING_DATA = 128
+
+class ShmRing:
+    """A single-producer/single-consumer byte ring in anonymous shared memory,
+    shared by processes forked after it is created. head and tail are free running
+    byte counters, only written by the producer and the consumer respectively.
+    Relies on stores becoming visible to the other process in program order
+    (as on x86), i.e. data before the head counter that covers it."""
+
+    def __init__(self, size):
+        self.size = size
+        self._mm = mmap.mmap(-1, _RING_DATA + size)
+
+    def write(self, data, offset=0):
+        """Copy as much of data[offset:] as fits, return the number of bytes written."""
+        mm = self._mm
+        head = _ring_counter.unpack_from(mm, _RING_HEAD)[0]
+        tail = _ring_counter.unpack_from(mm, _RING_TAIL)[0]
+        n = min(self.size - (head - tail), len(data) - offset)
+        if n <= 0:
+            return 0
+        pos = _RING_DATA + head % self.size
+        first = min(n, _RING_DATA + self.size - pos)
+        # N.B. mmap only accepts str for slice assignment
+        mm[pos:pos + first] = str(buffer(data, offset, first))
+        if first < n:
+            mm[_RING_DATA:_RING_DATA + n - first] = str(buffer(data, offset + first, n - first))
+        _ring_counter.pack_into(mm, _RING_HEAD, head + n)
+        return n
+
+    def read_into(self, view):
+        """Move as many bytes as are available and fit into view, return the number moved."""
+        mm = self._mm
+        head = _ring_counter.unpack_from(mm, _RING_HEAD)[0]
+        tail = _ring_counter.unpack_from(mm, _RING_TAIL)[0]
+        n = min(head - tail, len(view))
+        if n <= 0:
+            return 0
+        pos = _RING_DATA + tail % self.size
+        first = min(n, _RING_DATA + self.size - pos)
+        view[0:first] = mm[pos:pos + first]
+        if first < n:
+            view[first:n] = mm[_RING_DATA:_RING_DATA + n - first]
+        _ring_counter.pack_into(mm, _RING_TAIL, tail + n)
+        return n
+
+    def pending(self):
+        """Number of bytes written but not yet read."""
+        mm = self._mm
+        return _ring_counter.unpack_from(mm, _RING_HEAD)[0] - _ring_counter.unpack_from(mm, _RING_TAIL)[0]
+
+    def set_waiting(self, waiting):
+        """Set by the producer while it waits for room in a full ring."""
+        _ring_counter.pack_into(self._mm, _RING_WAITING, int(waiting))
+
+    def waiting(self):
+        return _ring_counter.unpack_from(self._mm, _RING_WAITING)[0] != 0
+
+    def close(self):
+        self._mm.close()
+
+def _nonblocking_pipe():
+    fds = os.pipe()
+    for fd in fds:
+        fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+    return fds
+
+def _write_wakeup(fd):
+    try:
+        os.write(fd, 'x')
+    except OSError, e:
+        # A full pipe means a wakeup is pending already
+        if e.errno != errno.EAGAIN:
+            raise
+
+class ShmSocket:
+    """The socket-like end of a pair of rings, providing what EndPoint needs.
+    Data is moved through the rings, a pipe is used only to wake up the reader,
+    and fileno() is the read end of that pipe so it can be polled like a socket.
+    A writer finding the ring full waits on a pipe of its own, written to by
+    the reader when it has made room."""
+
+    # Longest wait for room in a full ring before looking again, in case the
+    # reader missed the waiting flag (stores and loads may be reordered)
+    FULL_WAIT = 0.01
+
+    def __init__(self, rx, tx, rx_wake, tx_wake, rx_room, tx_room):
+        self._rx = rx
+        self._tx = tx
+        self._rx_wake = rx_wake
+        self._tx_wake = tx_wake
+        self._rx_room = rx_room     # Write end, to tell the writer of rx there is room
+        self._tx_room = tx_room     # Read end, to wait for room in tx
+        self._closed_by_peer = False
+
+    def fileno(self):
+        return self._rx_wake
+
+    def recv_into(self, view, nbytes=0):
+        if nbytes:
+            view = view[:nbytes]
+        # Drain wakeups before looking at the ring, so nothing written before
+        # a wakeup can be missed
+        try:
+            if not os.read(self._rx_wake, 4096):
+                self._closed_by_peer = True
+        except OSError, e:
+            if e.errno != errno.EAGAIN:
+                raise
+        received = self._rx.read_into(view)
+        if not received and not self._closed_by_peer:
+            raise socket.error(errno.EAGAIN, os.strerror(errno.EAGAIN))
+        if received and self._rx.waiting():
+            _write_wakeup(self._rx_room)
+        return received
+
+    def pending(self):
+        return self._rx.pending()
+
+    def sendall(self, data):
+        offset = 0
+        while offset < len(data):
+            written = self._tx.write(data, offset)
+            if written:
+                offset += written
+                _write_wakeup(self._tx_wake)
+            else:
+                self._wait_for_room()
+
+    def _wait_for_room(self):
+        tx = self._tx
+        tx.set_waiting(True)
+        try:
+            # The reader may have made room before it could see the flag
+            if tx.pending() < tx.size:
+                return
+            select.select([self._tx_room], [], [], self.FULL_WAIT)
+            try:
+                if not os.read(self._tx_room, 4096):
+                    raise socket.error(errno.EPIPE, os.strerror(errno.EPIPE))
+            except OSError, e:
+                if e.errno != errno.EAGAIN:
+                    raise
+        finally:
+            tx.set_waiting(False)
+
+    def close(self):
+        # N.B. Must not close twice, the descriptors may have been reused
+        if self._rx_wake is None:
+            return
+        for fd in (self._rx_wake, self._tx_wake, self._rx_room, self._tx_room):
+            os.close(fd)
+        self._rx_wake = self._tx_wake = self._rx_room = self._tx_room = None
+
+class ShmTransport(Transport):
+    """A pair of shared memory rings per node, one in each direction, created
+    before the backplane and nodes are started and inherited by them.
+    Relayed data is copied into and out of shared memory without system calls,
+    except for wakeups when the reader may be waiting."""
+
+    def __init__(self, urns, size=4194304):
+        self.channels_by_urn = {}
+        for urn in urns:
+            to_bp, to_node = ShmRing(size), ShmRing(size)
+            bp_wake, node_wake = _nonblocking_pipe(), _nonblocking_pipe()
+            # Room in to_bp, room in to_node
+            bp_room, node_room = _nonblocking_pipe(), _nonblocking_pipe()
+            bp_end = ShmSocket(to_bp, to_node, bp_wake[0], node_wake[1], bp_room[1], node_room[0])
+            node_end = ShmSocket(to_node, to_bp, node_wake[0], bp_wake[1], node_room[1], bp_room[0])
+            self.channels_by_urn[urn] = (bp_end, node_end)
+
+    def channels(self):
+        for bp_end, node_end in self.channels_by_urn.values():
+            node_end.close()
+        return [bp_end for bp_end, node_end in self.channels_by_urn.values()]
+
+    def connect(self, urn):
+        # Close what the node inherited from the Core, except our own end
+        for other, (bp_end, node_end) in self.channels_by_urn.iteritems():
+            bp_end.close()
+            if other != urn:
+                node_end.close()
+                node_end._rx.close()
+                node_end._tx.close()
+        return self.channels_by_urn[urn][1]
+
+    def release(self, urn=None):
+        if urn is None:
+            for bp_end, node_end in self.channels_by_urn.values():
+                bp_end.close()
+        else:
+            node_end = self.channels_by_urn[urn][1]
+            node_end.close()
+            node_end._rx.close()
+            node_end._tx.close()
+
+def create_transport(config):
+    """Create the transport given by the 'transport' entry of a simulation config,
+    either a type name or a dict with a 'type' and type specific parameters, e.g.
+        "transport": {"type": "unix", "path": "/tmp/parrot.sock"}
+    Defaults to TCP on port 1111."""
+    params = config.get('transport', {})
+    if isinstance(params, basestring):
+        params = {'type': params}
+    kind = params.get('type', 'tcp')
+    if kind == 'tcp':
+        return TcpTransport(params.get('host', ''), params.get('port', 1111))
+    elif kind == 'unix':
+        return UnixTransport(params.get('path', DEFAULT_UNIX_PATH % os.getpid()))
+    elif kind == 'socketpair':
+        return SocketPairTransport(config['nodes'].keys())
+    elif kind == 'shm':
+        return ShmTransport(config['nodes'].keys(), params.get('size', 4194304))
+    else:
+        raise ValueError("Unknown transport '%s'" % kind)
@@ -20,9 +20,13 @@ import signal
 import node
 import os
 import json
-import select
-import logger
+import log_service
+import poller
 import logging
+import comm_chan
+import shards
+import federation
+import networking
 from multiprocessing import Process, Pipe
 from weblink import create_weblink
 
@@ -37,16 +41,43 @@ class Core:
 
     """
 
-    def __init__(self):
+    def __init__(self, host=None):
         self.nodes = {}
         self.config = {}
-        self.logger = logger.Logger()
-        self.log_filter_params = [u'', u'', u'', u''] # FIXME: Hack
-        self.logger.setlog('urn:hodcp:core', 'Core instantiated', 'Core.init')
+        self.host = host or os.environ.get('PARROT_HOST')  # Federation host to run as
+        self.federation = None
+        self.transports = {}   # node urn -> transport of the backplane (shard) serving it
+        self.shards = []       # urns of the backplane shards, empty unless sharded
+        self.shard_of = {}     # node urn -> urn of its backplane shard
+        self.pending_replies = {}  # (dest, key) -> [shards left to reply, merged reply]
+        # The log database runs as a process of its own, started first so that it inherits nothing
+        if self.host:
+            logfile = '/tmp/parrotlogger-%s.db' % self.host
+        else:
+            logfile = '/tmp/parrotlogger.db'
+        self.nodes[log_service.URN] = self.dispatch(log_service.create_log_service, timeout=0, params=(logfile,))
+        self.log('Core instantiated', 'Core.init')
 
     def shutdown(self):
-        self.stop_nodes()
-        self.logger.close()
+        # The log service is stopped last, and also when a node can't be told to stop
+        logger = self.nodes.pop(log_service.URN, None)
+        try:
+            self.stop_nodes()
+        finally:
+            if logger:
+                self.stop_log_service(logger)
+
+    def stop_log_service(self, conn):
+        try:
+            conn.send({'dest':log_service.URN, 'action':'set', 'key':'running', 'value':False})
+        except (IOError, OSError):
+            # Already gone
+            pass
+        conn.close()
+
+    def log(self, msg, category=''):
+        request = {'dest':log_service.URN, 'sender':'urn:hodcp:core', 'action':'set', 'key':'log', 'value':msg, 'category':category}
+        self.send_control_msg(request)
 
     def dispatch(self, fcn, timeout=0, params=()):
         """Start a new subrocess.
@@ -96,6 +127,9 @@ class Core:
             print '[Core] Cannot load config file: '+config_file
             sys.exit(1)
 
+        # Retention policy etc. of the log
+        self.set_node_property(log_service.URN, 'config', self.config.get('logger', {}))
+
         if 'description' in self.config.keys():
             formatted_description = (
             "========================================\n"+
@@ -104,6 +138,19 @@ class Core:
             )
             print formatted_description
 
+        # The binary wire protocol carries IPv4 addresses only. Decided here,
+        # from the whole config, so all shards and hosts use the same protocol.
+        if self.config.get('wire_protocol') == networking.BINARY.name:
+            address = networking.non_ipv4_address(self.config)
+            if address:
+                print '[Core] Address %s is not IPv4, using the text wire protocol' % address
+                self.config['wire_protocol'] = networking.TEXT.name
+
+        weblink_port = 1112
+        if 'federation' in self.config:
+            self.setup_federation()
+            weblink_port = self.config['federation']['hosts'][self.host].get('weblink', weblink_port)
+
         # Network backplane. Use default unless supplied by user in env var BACKPLANE
         backplane_module_name = os.environ.get('BACKPLANE', 'backplane')
         backplane_module = None
@@ -122,15 +169,60 @@ class Core:
             if backplane_filehandle:
                 backplane_filehandle.close()
 
-        self.nodes['urn:backplane'] = self.dispatch(backplane_module.create_backplane, timeout=30, params=(1111, self.config, ))
-
-        # Create weblink
-        self.nodes['urn:weblink'] = self.dispatch(create_weblink, timeout=0, params=(1112,))
+        # Create weblink (first, so that it doesn't inherit any comm channel sockets)
+        self.nodes['urn:weblink'] = self.dispatch(create_weblink, timeout=0, params=(weblink_port, self.config.get('weblink', {})))
+
+        # One backplane, or one per shard with a subset of nodes and networks.
+        # Each backplane is started right before its nodes, so that no process
+        # inherits the comm channel sockets of another shard.
+        count = shards.shard_count(self.config)
+        if count > 1 and self.federation:
+            print '[Core] Sharding is not supported together with federation, using one backplane'
+        elif count > 1:
+            shard_configs = shards.partition(self.config, count)
+        else:
+            shard_configs = [self.config]
+        for index, shard_config in enumerate(shard_configs):
+            bp_urn = 'urn:backplane'
+            if len(shard_configs) > 1:
+                bp_urn = 'urn:backplane:%d' % index
+                self.shards.append(bp_urn)
+            self.setup_backplane(backplane_module, bp_urn, shard_config)
+
+    def setup_federation(self):
+        """Run as one of the hosts of a federated simulation, see federation.py."""
+        if not self.host:
+            print '[Core] Federated simulation, set PARROT_HOST (or use --host) to the host to run as'
+            sys.exit(1)
+        self.config['federation']['host'] = self.host
+        try:
+            self.federation = federation.Federation(self.config)
+        except ValueError, e:
+            print '[Core] Bad federation config: %s' % e
+            sys.exit(1)
+        host_config = self.config['federation']['hosts'][self.host]
+        if 'transport' in host_config:
+            self.config['transport'] = host_config['transport']
+
+    def local_nodes(self, config):
+        """The nodes of config to run here, i.e. all unless federated."""
+        if not self.federation:
+            return config['nodes']
+        return dict((urn, node_config) for urn, node_config in config['nodes'].iteritems()
+                    if self.federation.is_local(urn))
+
+    def setup_backplane(self, backplane_module, bp_urn, config):
+        nodes = self.local_nodes(config)
+        # How nodes reach the backplane, sockets etc. are created before any of them is started
+        transport = comm_chan.create_transport(dict(config, nodes=nodes))
+        self.nodes[bp_urn] = self.dispatch(backplane_module.create_backplane, timeout=30, params=(transport, config, ))
+        transport.release()
 
         # Create nodes
-        urns = self.config['nodes'].keys()
-        for urn in urns:
-            node_config = self.config['nodes'][urn]
+        for urn, node_config in nodes.iteritems():
+            self.transports[urn] = transport
+            if self.shards:
+                self.shard_of[urn] = bp_urn
             self.setup_node(urn, node_config)
 
     def setup_node(self, urn, node_config):
@@ -141,7 +233,12 @@ class Core:
                 nw_urn = node_config['interfaces'][iface].get('network')
                 if nw_urn:
                     node_config['interfaces'][iface]['config'] = networks[nw_urn]
-        self.nodes[urn] = self.dispatch(node.create_node, timeout=0, params=(node_config, urn,))
+        # Log limits of the simulation, unless the node has its own
+        if 'log_limits' in self.config:
+            node_config.setdefault('log_limits', self.config['log_limits'])
+        transport = self.transports[urn]
+        self.nodes[urn] = self.dispatch(node.create_node, timeout=0, params=(node_config, urn, transport))
+        transport.release(urn)
 
     def control_message(self, msg):
         # print "[Core::send_control_msg] msg = '%s'" % msg
@@ -149,16 +246,9 @@ class Core:
             reply = {'dest':msg['sender'], 'sender':msg['dest'], 'action':'set', 'key':'config', 'value':self.config}
             self.send_control_msg(reply)
 
-        elif msg['action'] == 'set' and msg['key'] == 'log':
-            self.logger.setlog(msg['sender'], msg['value'])
-
-        elif msg['action'] == 'set' and msg['key'] == 'log_filter':
-            self.log_filter_params = msg['value']
-
-        elif msg['action'] == 'get' and msg['key'] == 'log':
-            log = self.logger.getlog(*self.log_filter_params)
-            reply = {'dest':msg['sender'], 'sender':msg['dest'], 'action':'set', 'key':'log', 'value':log}
-            self.send_control_msg(reply)
+        elif msg['key'] in log_service.LOG_KEYS:
+            # Logging used to be handled here, pass it on
+            self.nodes[log_service.URN].send(msg)
 
         else:
             print "[Core] Unknown message: %s" % msg
@@ -168,6 +258,12 @@ class Core:
             # print "[Core] Ignoring %s" % str(msg)
             pass
 
+        elif self.shards and msg['dest'] == 'urn:backplane':
+            self.send_shards_msg(msg)
+
+        elif self.shards and msg.get('sender') == 'urn:backplane' and (msg['dest'], msg['key']) in self.pending_replies:
+            self.merge_shards_reply(msg)
+
         elif msg['dest'] in self.nodes:
             # print "\033[34m [Core::send_control_msg] dispatching to node : \033[0m  msg = '%s'" % msg
             conn = self.nodes[msg['dest']]
@@ -180,6 +276,30 @@ class Core:
         else:
             print "[Core] Unknown destination URN: %s" % msg['dest']
 
+    def send_shards_msg(self, msg):
+        """Pass a message for the backplane on to the shard owning the interface
+        it concerns, or else to every shard, collecting their replies to a get."""
+        owner = self.shard_of.get(msg['key'].rpartition(':')[0])
+        if owner:
+            self.nodes[owner].send(msg)
+            return
+        if msg['action'] == 'get':
+            self.pending_replies[(msg['sender'], msg['key'])] = [len(self.shards), None]
+        for bp_urn in self.shards:
+            self.nodes[bp_urn].send(msg)
+
+    def merge_shards_reply(self, msg):
+        """Combine shard replies into one, e.g. the union of their capabilities."""
+        pending = self.pending_replies[(msg['dest'], msg['key'])]
+        if pending[1] is None:
+            pending[1] = msg
+        elif isinstance(msg['value'], dict):
+            pending[1]['value'].update(msg['value'])
+        pending[0] -= 1
+        if pending[0] == 0:
+            del self.pending_replies[(msg['dest'], msg['key'])]
+            self.send_control_msg(pending[1])
+
     def broadcast(self, msg):
         for urn in self.nodes.keys():
             msg['dest'] = urn
@@ -204,10 +324,12 @@ class Core:
     def serve(self):
         # FIXME: Should be possible to attach tools when running, much like e.g. weblink
         print "[Core] Platform running."
+        inputs = poller.Poller()
+        for conn in self.nodes.values():
+            inputs.register(conn)
         running = 1
         while running:
-            inputready, _, _ = select.select(self.nodes.values(),[],[])
-            for s in inputready:
+            for s, _ in inputs.poll():
                 msg = s.recv()
                 if not msg:
                     print "[Core] input source closed down..."
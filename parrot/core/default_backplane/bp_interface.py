@@ -40,6 +40,10 @@ class Interface:
         self.log(data, self)
         self.relay_handler(data, self)
 
-    def send(self, data):
+    def send(self, data, flush=False):
         self.log(data, self)
-        self.node.send(data, self)
+        self.node.send(data, self, flush)
+
+    def forward(self, prefix, data):
+        """Send prefix followed by data, unlogged (cut-through path)."""
+        self.node.send(data, self, prefix=prefix)
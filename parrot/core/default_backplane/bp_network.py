@@ -14,36 +14,82 @@
 #
 ########################################################################
 
-import uuid
 from parrot.core import networking
 
+# Listeners on interfaces without an address are reached on any address
+WILDCARD = '0.0.0.0'
+
 class Network:
-    def __init__(self, network_urn, config):
+    def __init__(self, network_urn, config, codec=networking.TEXT, ids=None):
         self.urn = network_urn
         self.properties = config
+        self.codec = codec          # Wire protocol of the socket messages
+        self.ids = ids or networking.IdSpace(0)  # Ids of server side connections
         self.listeners = {}         # Registered listeners (TCP & UDP)
+        self.listener_index = {}    # Mapping (ip, port) to listener connection_ids
         self.mapping = {}           # Mapping from connection_id to interface (TCP)
         self.connections = {}       # Mapping connection_id to peer connection_id (TCP)
+        self.routes = {}            # Mapping connection_id of accepted connections to
+                                    # (peer interface, prefix of RECEIVED messages to it)
+        self.cut_through = True     # Forward SEND on accepted connections unparsed
 
     def description(self):
         print '[%s] ' % self.urn, self.properties
 
     def lookup(self, ip, port):
-        server_cids = [cid for cid in self.listeners if (self.listeners[cid]['ip'] == ip and
-                                                         self.listeners[cid]['port'] == port)]
+        """Return the (possibly empty) list of listeners on ip and port,
+        falling back to listeners on the wildcard address. Don't modify it."""
+        server_cids = self.listener_index.get((ip, port))
+        if not server_cids:
+            server_cids = self.listener_index.get((WILDCARD, port), [])
         return server_cids
 
+    def add_listener(self, cid, interface, ip, port):
+        listener = self.listeners.get(cid)
+        if listener:
+            if (listener['ip'], listener['port']) == (ip, port):
+                # Already listening (UDP sockets re-register on every receive)
+                listener['interface'] = interface
+                return
+            self.remove_listener(cid)
+        self.listeners[cid] = {'interface':interface, 'ip':ip, 'port':port}
+        self.listener_index.setdefault((ip, port), []).append(cid)
+
+    def remove_listener(self, cid):
+        listener = self.listeners.pop(cid)
+        key = (listener['ip'], listener['port'])
+        cids = self.listener_index[key]
+        cids.remove(cid)
+        if not cids:
+            del self.listener_index[key]
+
+    def add_route(self, cid):
+        # The other end may have disconnected already
+        if cid in self.connections:
+            peer_cid = self.connections[cid]
+            self.routes[cid] = (self.mapping[cid], self.codec.message_prefix(networking.RECEIVED, peer_cid))
+
     def remove_from_map(self, src_cid):
+        self.routes.pop(src_cid, None)
         if src_cid in self.mapping:
             del self.mapping[src_cid]
         if src_cid in self.connections:
             del self.connections[src_cid]
         if src_cid in self.listeners:
-            del self.listeners[src_cid]
+            self.remove_listener(src_cid)
 
     def relay_handler(self, data, sender):
         """sender is an Interface."""
-        cmd, params = networking.parse_message(data)
+        if self.cut_through:
+            # Established connection: rewrite the id, pass the payload as is
+            split = self.codec.split_message(data, networking.SEND)
+            if split:
+                route = self.routes.get(split[0])
+                if route:
+                    route[0].forward(route[1], split[1])
+                    return
+
+        cmd, params = self.codec.parse_message(data)
 
         handlers = {
             networking.LISTEN: self.listen,
@@ -65,8 +111,8 @@ class Network:
     def listen(self, sender, **params):
         # Create new listener
         cid, port = (params['id'], params['port'])
-        server_ip = sender.properties['ip']
-        self.listeners[cid] = {'interface':sender, 'ip':server_ip, 'port':port}
+        server_ip = sender.properties.get('ip', WILDCARD)
+        self.add_listener(cid, sender, server_ip, port)
         # print self.listeners
         return True
 
@@ -88,9 +134,9 @@ class Network:
 
         # Inform the server
         server_cid = server_cids[0]
-        server_connection_cid = str(uuid.uuid4())
+        server_connection_cid = self.ids.new_id()
         server_interface = self.listeners[server_cid]['interface']
-        msg = networking.build_message(networking.NEW_CONN, id=server_cid, new_id=server_connection_cid)
+        msg = self.codec.build_message(networking.NEW_CONN, id=server_cid, new_id=server_connection_cid)
         server_interface.send(msg)
 
         # Mapping from connection_id to interface
@@ -104,7 +150,7 @@ class Network:
         # Relay to other end of connection
         src_cid, payload = (params['id'], params['payload'])
         dst = self.mapping[src_cid]
-        msg = networking.build_message(networking.RECEIVED, id=self.connections[src_cid], payload=payload)
+        msg = self.codec.build_message(networking.RECEIVED, id=self.connections[src_cid], payload=payload)
         dst.send(msg)
         return True
 
@@ -112,12 +158,16 @@ class Network:
         # Acknowledge to other end of connection
         src_cid = params['id']
         dst = self.mapping[src_cid]
-        msg = networking.build_message(networking.ACCEPTED, id=self.connections[src_cid])
-        dst.send(msg)
+        msg = self.codec.build_message(networking.ACCEPTED, id=self.connections[src_cid])
+        # The client is blocked in connect() until this arrives
+        dst.send(msg, flush=True)
+        # The connection is established, traffic can take the cut-through path
+        self.add_route(src_cid)
+        self.add_route(self.connections[src_cid])
         return True
 
     def sendto(self, sender, **params):
-        # e.g. SENDTO 79c1fb86-3c97-4c19-80ae-92e9e02251c1 2137 10.1.2.2 4321 Hello over UDP
+        # e.g. SENDTO 4294967298 2137 10.1.2.2 4321 Hello over UDP
         (src_cid, src_port, dest_ip, dest_port, payload) = (params['id'], params['src_port'], params['dst_ip'], params['dst_port'], params['payload'])
         src_ip = sender.properties['ip']
         dest_ids = self.lookup(dest_ip, dest_port)
@@ -126,17 +176,17 @@ class Network:
 
         dst_id = dest_ids[0]
         dst = self.listeners[dst_id]['interface']
-        msg = networking.build_message(networking.RECDFROM, id=dst_id, dst_port=dest_port, src_ip=src_ip, src_port=src_port, payload=payload)
+        msg = self.codec.build_message(networking.RECDFROM, id=dst_id, dst_port=dest_port, src_ip=src_ip, src_port=src_port, payload=payload)
         dst.send(msg)
         return True
 
     def recvfrom(self, sender, **params):
-        # e.g. RECVFROM a8a232d3-f90a-44f6-847c-9efe8e185d21 0.0.0.0 4321
+        # e.g. RECVFROM 8589934593 0.0.0.0 4321
         # This UDP socket is now actively listening.
         (cid, port) = (params['id'], params['port'])
-        server_ip = sender.properties['ip']
+        server_ip = sender.properties.get('ip', WILDCARD)
         sender.properties['port'] = port
-        self.listeners[cid] = {'interface':sender, 'ip':server_ip, 'port':port}
+        self.add_listener(cid, sender, server_ip, port)
         return True
 
     def disconnect(self, sender, **params):
@@ -145,7 +195,7 @@ class Network:
         # If source is TCP inform other end of connection that we're closing
         if src_cid in self.mapping:
             dst = self.mapping[src_cid]
-            msg = networking.build_message(networking.DISCONN, id=self.connections[src_cid])
+            msg = self.codec.build_message(networking.DISCONN, id=self.connections[src_cid])
             dst.send(msg)
 
         self.remove_from_map(src_cid)
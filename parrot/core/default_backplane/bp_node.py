@@ -33,11 +33,11 @@ class Node:
 
     def relay(self, data):
         """From Parrot node via backplane server"""
-        if_name = data[0:4]
+        if_name = data[0:4].tobytes()
         message = data[4:]
         self.interfaces[if_name].relay(message)
 
-    def send(self, data, sender):
-        """To Parrot node via CommChan socket"""
-        self.cc.send_cmd(data, sender)
+    def send(self, data, sender, flush=False, prefix=''):
+        """To Parrot node via CommChan socket, flush to send immediately"""
+        self.cc.send_cmd(data, sender, flush=flush, prefix=prefix)
 
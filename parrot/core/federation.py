@@ -0,0 +1,284 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""Federation of several Parrot instances (hosts) into one simulation.
+
+Each host runs the nodes listed for it, and every network and serial link is
+relayed by the backplane of the host owning it. Frames between a node and a
+backplane on another host are carried over peer links between the backplanes:
+    "federation": {
+        "hosts": {
+            "a": {"address": "10.0.0.1", "port": 7001, "nodes": ["urn:hodcp:node:1"]},
+            "b": {"address": "10.0.0.2", "port": 7001, "nodes": ["urn:hodcp:node:2"]}
+        }
+    }
+A network is owned by the host given by its "host" entry, or else by the host
+of its first node in sort order. A serial link is owned by the host of its
+source node. A host entry may also give the "transport" and "weblink" port to
+use, and each host logs to a database of its own, so that several hosts can
+run on one machine.
+The host an instance runs as is given by PARROT_HOST or the launcher's --host.
+"""
+
+import errno
+import os
+import socket
+import struct
+import time
+import comm_chan
+import poller
+
+# Frame tags on peer links, the payload is <urn length[2]><urn><if[4]><data[N]>
+RELAY = 'rlay'      # From a node to the backplane owning its network or link
+DELIVER = 'dlvr'    # From that backplane back to the node
+
+_urn_length = struct.Struct('!H')
+
+# How long to keep trying to reach a host that is not up yet
+CONNECT_TIMEOUT = 30.0
+CONNECT_RETRY = 0.1
+
+# Bytes queued on a peer link before further frames are dropped
+MAX_QUEUE = 16 * 1024 * 1024
+
+
+class Federation:
+    """Which host runs each node, and which host owns each network and serial link."""
+
+    def __init__(self, config):
+        params = config['federation']
+        self.host = params.get('host')
+        self.hosts = params['hosts']
+        if self.host not in self.hosts:
+            raise ValueError("Unknown federation host '%s'" % self.host)
+
+        self.host_of = {}
+        for host, host_config in self.hosts.iteritems():
+            for urn in host_config.get('nodes', []):
+                self.host_of[urn] = host
+        missing = set(config['nodes']) - set(self.host_of)
+        if missing:
+            raise ValueError("Nodes not assigned to any host: %s" % ', '.join(sorted(missing)))
+
+        # Network urn, or interface urn of serial link ends -> owning host
+        self.owner_of = {}
+        for node_urn in sorted(config['nodes']):
+            for if_conf in config['nodes'][node_urn]['interfaces'].values():
+                network = if_conf.get('network')
+                if network and network not in self.owner_of:
+                    nw_config = config.get('networks', {}).get(network, {})
+                    self.owner_of[network] = nw_config.get('host', self.host_of[node_urn])
+        for src, dst in config.get('links', {}).iteritems():
+            owner = self.host_of[src.rpartition(':')[0]]
+            self.owner_of[src] = self.owner_of[dst] = owner
+
+    def is_local(self, node_urn):
+        return self.host_of[node_urn] == self.host
+
+    def owner(self, node_urn, if_name, if_conf):
+        """Host relaying the network or link of an interface, None if unattached."""
+        network = if_conf.get('network')
+        if network:
+            return self.owner_of.get(network)
+        return self.owner_of.get('%s:%s' % (node_urn, if_name))
+
+    def listen(self):
+        """Return the socket other hosts connect their peer links to."""
+        host_config = self.hosts[self.host]
+        server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        server.bind((host_config.get('address', ''), host_config['port']))
+        server.listen(len(self.hosts))
+        return server
+
+def split_frame(data):
+    """Split the payload of a peer link frame into the node urn and <if[4]><data[N]>."""
+    size = _urn_length.unpack_from(data)[0]
+    end = _urn_length.size + size
+    return data[_urn_length.size:end].tobytes(), data[end:]
+
+class _Tag:
+    """Frame tags are taken from the name of the sender passed to send_cmd()."""
+    def __init__(self, name):
+        self.name = name
+
+_tags = {RELAY: _Tag(RELAY), DELIVER: _Tag(DELIVER)}
+
+class PeerLink(comm_chan.EndPoint):
+    """Outgoing link to the backplane of another host, connected on first use.
+
+    Frames are coalesced like on comm channels, and written without blocking
+    so that two hosts sending to each other can't deadlock. Connecting doesn't
+    block either, a host that is not up yet is retried every CONNECT_RETRY
+    seconds for CONNECT_TIMEOUT seconds, see timeout() and check(). The link
+    keeps itself registered with the backplane's poller, for reading to notice
+    the other end closing and for writing while connecting or while frames are
+    held up, and poll events are passed to handle_event().
+    Frames sent while more than MAX_QUEUE bytes are held up are dropped.
+    """
+
+    def __init__(self, host, address, port, inputs):
+        comm_chan.EndPoint.__init__(self)
+        self.urn = host
+        self.address = (address, port)
+        self.inputs = inputs
+        self.framing = comm_chan.FRAMING_BINARY
+        self.coalesce = True
+        self.connecting = False     # Waiting for a connect to complete
+        self.deadline = None        # Time to give up connecting
+        self.retry_at = None        # Time to try connecting again
+        self.dropped = 0            # Frames dropped since the queue was last empty
+
+    def send_frame(self, tag, urn, if_name, data, flush=False, prefix=''):
+        if len(self._wbuf) >= MAX_QUEUE:
+            if not self.dropped:
+                print '[Federation] Link to host %s is backed up, dropping frames' % self.urn
+            self.dropped += 1
+            return
+        urn = str(urn)
+        msg = bytearray(_urn_length.pack(len(urn)))
+        msg += urn
+        msg += str(if_name)
+        msg += prefix
+        msg += data
+        self.send_cmd(msg, _tags[tag], flush=flush)
+
+    def relay_handler(self, data, sender):
+        """Relay handler for interfaces whose network or link this host owns."""
+        self.send_frame(RELAY, sender.node.urn, sender.name, data)
+
+    def handle_event(self, events):
+        if self.connecting:
+            # Writable, or an error, once the connect is done
+            err = self._socket.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+            if err:
+                self._connect_failed(err)
+            else:
+                self._connected()
+                self.flush()
+            return
+        if events & poller.READ:
+            # Nothing is ever sent this way, so it's the other end closing
+            try:
+                data = self._socket.recv(4096)
+            except socket.error:
+                data = ''
+            if not data:
+                self.reset('closed by peer')
+                return
+        if events & poller.WRITE:
+            self.flush()
+
+    def reset(self, reason):
+        print '[Federation] Link to host %s lost (%s), dropped %d bytes' % (self.urn, reason, len(self._wbuf))
+        self.inputs.update(self, 0)
+        self._socket.close()
+        self._socket = None
+        self._wbuf = bytearray()
+        self.dropped = 0
+
+    def timeout(self, now):
+        """Seconds until check() is due, None if the link isn't waiting for anything."""
+        if self.connecting:
+            return max(0, self.deadline - now)
+        if self.retry_at:
+            return max(0, self.retry_at - now)
+        return None
+
+    def check(self, now):
+        """Give up a connect that takes too long, or schedule the next attempt."""
+        if self.connecting and now >= self.deadline:
+            self._connect_failed(errno.ETIMEDOUT)
+        elif self.retry_at and now >= self.retry_at:
+            self.retry_at = None
+            self.write_pending(self)
+
+    def _connect(self):
+        if self.deadline is None:
+            self.deadline = time.time() + CONNECT_TIMEOUT
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.setblocking(0)
+        self._socket = sock
+        err = sock.connect_ex(self.address)
+        if err in (errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY):
+            self.connecting = True
+            self.inputs.update(self, poller.WRITE)
+        elif err in (0, errno.EISCONN):
+            self._connected()
+        else:
+            self._connect_failed(err)
+
+    def _connected(self):
+        self.connecting = False
+        self.deadline = None
+        self._socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def _connect_failed(self, err):
+        self.connecting = False
+        self.inputs.update(self, 0)
+        self._socket.close()
+        self._socket = None
+        if time.time() < self.deadline:
+            self.retry_at = time.time() + CONNECT_RETRY
+            return
+        print '[Federation] Cannot reach host %s at %s:%d: %s, dropped %d bytes' % (
+            (self.urn,) + self.address + (os.strerror(err), len(self._wbuf)))
+        self.deadline = None
+        self._wbuf = bytearray()
+        self.dropped = 0
+
+    def _flush(self):
+        if not self._wbuf or self.retry_at:
+            return
+        if self._socket is None:
+            self._connect()
+        if self._socket is None or self.connecting:
+            # Sent once connected
+            return
+        try:
+            sent = self._socket.send(self._wbuf)
+        except socket.error, e:
+            if e.errno not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                self.reset(e)
+                return
+            sent = 0
+        del self._wbuf[:sent]
+        if self._wbuf:
+            self.inputs.update(self, poller.READ | poller.WRITE)
+        else:
+            self.inputs.update(self, poller.READ)
+            if self.dropped:
+                print '[Federation] Link to host %s dropped %d frames while backed up' % (self.urn, self.dropped)
+                self.dropped = 0
+
+class PeerLinkBack(comm_chan.EndPoint):
+    """Incoming link from the backplane of another host."""
+
+    def __init__(self, sock):
+        comm_chan.EndPoint.__init__(self)
+        self._socket = sock
+        self.framing = comm_chan.FRAMING_BINARY
+
+class RemoteChannel:
+    """Stands in for the comm channel of a node on another host, in the
+    backplane owning a network or link of that node."""
+
+    def __init__(self, link, urn):
+        self.link = link
+        self.urn = urn
+
+    def send_cmd(self, msg, sender, msg_type=comm_chan.MSG_DATA, flush=False, prefix=''):
+        self.link.send_frame(DELIVER, self.urn, sender.name, msg, flush, prefix)
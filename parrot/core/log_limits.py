@@ -0,0 +1,128 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""Rate limits and sampling of the log lines of nodes and the backplane.
+
+Lines over the limits are dropped before they are encoded, printed or sent to
+the logger, so a limited log costs next to nothing. Limits are given by
+    "log_limits": {
+        "rate": 100,      -- lines per second (default unlimited)
+        "burst": 500,     -- lines logged at once after a quiet period (default rate, at least 1)
+        "sample": 10,     -- log 1 in 10 lines (default 1, every line)
+        "urns": {"urn:hodcp:node:1:*": {"rate": 10}},
+        "categories": {"debug": {"sample": 100}}
+    }
+in the simulation config, or in the config of a node, and may be changed while
+running by sending 'set log_limits' to a node or urn:backplane.
+Each urn and category has limits of its own: the defaults, overridden by those
+of the urn, overridden by those of the category. Names are looked up as they are,
+else matched against the patterns (see fnmatch) in sorted order, the first match
+counts. Lines are sampled first, then rate limited.
+
+'get log_dropped' replies with the number of lines dropped, {urn: {category: count}}.
+"""
+
+import fnmatch
+import time
+
+# Keys of the control messages handled by LogLimiter.get() and LogLimiter.configure()
+KEYS = ('log_limits', 'log_dropped')
+
+_LIMITS = ('rate', 'burst', 'sample')
+
+class Budget:
+    """What an urn and category may log."""
+
+    def __init__(self, rate=None, burst=None, sample=1):
+        self.rate = float(rate) if rate is not None else None
+        if burst is not None:
+            self.burst = float(burst)
+        elif self.rate is not None:
+            self.burst = max(self.rate, 1.0)
+        else:
+            self.burst = 1.0
+        self.sample = int(sample)
+        if (self.rate is not None and self.rate < 0) or self.burst < 1:
+            raise ValueError('Bad log rate %s (burst %s)' % (rate, burst))
+        if self.sample < 1:
+            raise ValueError('Bad log sample %s, must be at least 1' % sample)
+        self.tokens = self.burst
+        self.last = time.time()
+        self.seen = 0
+
+    def allow(self):
+        self.seen += 1
+        if self.sample > 1 and (self.seen - 1) % self.sample:
+            return False
+        if self.rate is not None:
+            now = time.time()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                return False
+            self.tokens -= 1
+        return True
+
+class LogLimiter:
+
+    def __init__(self, config=None):
+        self.config = {}
+        self.budgets = {}   # (urn, category) -> Budget
+        self.dropped = {}   # urn -> {category: lines dropped}
+        self.configure(config)
+
+    def configure(self, config):
+        """Set the limits (see above), None or {} for none. Raise ValueError
+        for a bad config, keeping the limits as they were."""
+        config = config or {}
+        if not isinstance(config, dict):
+            raise ValueError('Bad log limits %s' % config)
+        try:
+            for limits in [config] + config.get('urns', {}).values() + config.get('categories', {}).values():
+                Budget(**dict((key, limits[key]) for key in _LIMITS if key in limits))
+        except (TypeError, ValueError, AttributeError), e:
+            raise ValueError('Bad log limits %s: %s' % (config, e))
+        self.config = config
+        self.budgets = {}
+
+    def allow(self, urn, category=''):
+        """Tell if a line may be logged, counting it as dropped if not."""
+        if not self.config:
+            return True
+        try:
+            budget = self.budgets[(urn, category)]
+        except KeyError:
+            budget = self.budgets[(urn, category)] = Budget(**self.limits(urn, category))
+        if budget.allow():
+            return True
+        dropped = self.dropped.setdefault(urn, {})
+        dropped[category] = dropped.get(category, 0) + 1
+        return False
+
+    def limits(self, urn, category=''):
+        limits = dict((key, self.config[key]) for key in _LIMITS if key in self.config)
+        for name, patterns in ((urn, self.config.get('urns', {})), (category, self.config.get('categories', {}))):
+            matches = [name] if name in patterns else [p for p in sorted(patterns) if fnmatch.fnmatchcase(name, p)]
+            if matches:
+                limits.update((key, patterns[matches[0]][key]) for key in _LIMITS if key in patterns[matches[0]])
+        return limits
+
+    def get(self, key):
+        if key == 'log_limits':
+            return self.config
+        if key == 'log_dropped':
+            return self.dropped
+        return None
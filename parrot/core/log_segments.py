@@ -0,0 +1,339 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""Columnar log backend for high log rates, e.g. packet logging of the backplane.
+
+Events are appended to segments, each a pair of memory mapped files:
+    <n>.cols -- column arrays of timestamp, urn id, category id and message end offset
+    <n>.msg  -- the messages, back to back (utf-8)
+Urns and categories are stored as ids of a name table kept in memory. Logging an
+event is a few writes to memory, there is no database and no transaction.
+
+Each segment indexes its rows by urn. Timestamps never decrease, so a time range
+is a range of rows, found by binary search. getlog() takes the filters of
+Logger.getlog() and scans the columns with numpy, if installed. The messages are
+only read for the rows left, to test the msg filters and build the result.
+Full-text queries (match) are limited to words, "phrases" and prefixes.
+
+Use it by
+    "logger": {"backend": "segments"}
+in the simulation config. Retention (see Logger.configure()) drops whole segments.
+"""
+
+import array
+import bisect
+import gzip
+import json
+import mmap
+import os
+import shutil
+import struct
+import time
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import logger
+
+# A segment holds at most this many events, and this many bytes of messages
+SEGMENT_ROWS = 1 << 20
+SEGMENT_BYTES = 64 * 1024 * 1024
+
+# Columns of a segment, offsets in the .cols file
+_TS, _URN, _CAT, _END = struct.Struct('q'), struct.Struct('I'), struct.Struct('I'), struct.Struct('Q')
+_TS_OFF = 0
+_URN_OFF = _TS_OFF + _TS.size * SEGMENT_ROWS
+_CAT_OFF = _URN_OFF + _URN.size * SEGMENT_ROWS
+_END_OFF = _CAT_OFF + _CAT.size * SEGMENT_ROWS
+_COLS_SIZE = _END_OFF + _END.size * SEGMENT_ROWS
+
+def _map(filename, size):
+    # Sparse file, only the pages written to take up space
+    f = open(filename, 'w+b')
+    try:
+        f.truncate(size)
+        return mmap.mmap(f.fileno(), size)
+    finally:
+        f.close()
+
+def _encode(msg):
+    if isinstance(msg, unicode):
+        return msg.encode('utf-8')
+    if isinstance(msg, str):
+        return msg
+    return unicode(msg).encode('utf-8')
+
+class Segment:
+
+    def __init__(self, path, first_id):
+        self.path = path
+        self.first_id = first_id   # id of row 0
+        self.rows = 0
+        self.used = 0              # bytes of messages
+        self.by_urn = {}           # urn id -> array of its rows
+        self.cols = _map(path + '.cols', _COLS_SIZE)
+        self.msgs = _map(path + '.msg', SEGMENT_BYTES)
+
+    def append(self, timestamp, urn_id, cat_id, data):
+        """Add an event, return False if the segment is full."""
+        row, end = self.rows, self.used + len(data)
+        if row == SEGMENT_ROWS or end > SEGMENT_BYTES:
+            return False
+        self.msgs[self.used:end] = data
+        _TS.pack_into(self.cols, _TS_OFF + _TS.size * row, timestamp)
+        _URN.pack_into(self.cols, _URN_OFF + _URN.size * row, urn_id)
+        _CAT.pack_into(self.cols, _CAT_OFF + _CAT.size * row, cat_id)
+        _END.pack_into(self.cols, _END_OFF + _END.size * row, end)
+        try:
+            self.by_urn[urn_id].append(row)
+        except KeyError:
+            self.by_urn[urn_id] = array.array('I', (row,))
+        self.rows, self.used = row + 1, end
+        return True
+
+    def close(self, remove=False):
+        self.cols.close()
+        self.msgs.close()
+        if remove:
+            os.remove(self.path + '.cols')
+            os.remove(self.path + '.msg')
+
+    def size(self):
+        return self.used + (_TS.size + _URN.size + _CAT.size + _END.size) * self.rows
+
+    def timestamp(self, row):
+        return _TS.unpack_from(self.cols, _TS_OFF + _TS.size * row)[0]
+
+    def column(self, offset, typecode, lo, hi):
+        """Rows lo to hi of a column, as a numpy array if numpy is installed."""
+        if numpy:
+            return numpy.frombuffer(self.cols, typecode, hi - lo, offset + lo * struct.calcsize(typecode))
+        return array.array(typecode, self.cols[offset + lo * struct.calcsize(typecode):
+                                               offset + hi * struct.calcsize(typecode)])
+
+    def bisect(self, timestamp):
+        """The first row at or after timestamp."""
+        if numpy:
+            return int(numpy.searchsorted(self.column(_TS_OFF, 'q', 0, self.rows), timestamp))
+        lo, hi = 0, self.rows
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self.timestamp(mid) < timestamp:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def select(self, lo, hi, urn_ids, cat_ids):
+        """Rows lo to hi (in order) with an urn in urn_ids and a category in
+        cat_ids, either of which may be None for any."""
+        if urn_ids is not None and len(urn_ids) == 1:
+            # Look the urn up in the index, rather than scan
+            rows = self.by_urn.get(iter(urn_ids).next(), ())
+            rows = rows[bisect.bisect_left(rows, lo):bisect.bisect_left(rows, hi)]
+            urn_ids = None
+        else:
+            rows = None
+        if rows is None:
+            rows = xrange(lo, hi)
+        if numpy and (urn_ids is not None or cat_ids is not None):
+            rows = numpy.arange(lo, hi) if isinstance(rows, xrange) else numpy.array(rows, 'I')
+            for offset, ids in ((_URN_OFF, urn_ids), (_CAT_OFF, cat_ids)):
+                if ids is not None and len(rows):
+                    column = self.column(offset, 'I', 0, self.rows)
+                    rows = rows[numpy.in1d(column[rows], list(ids))]
+            return rows.tolist()
+        for offset, ids in ((_URN_OFF, urn_ids), (_CAT_OFF, cat_ids)):
+            if ids is not None and len(rows):
+                column = self.column(offset, 'I', lo, hi)
+                rows = [row for row in rows if column[row - lo] in ids]
+        return rows
+
+    def message(self, row):
+        start = _END.unpack_from(self.cols, _END_OFF + _END.size * (row - 1))[0] if row else 0
+        end = _END.unpack_from(self.cols, _END_OFF + _END.size * row)[0]
+        return self.msgs[start:end].decode('utf-8', 'replace')
+
+class SegmentLogger:
+    """A log like logger.Logger (same methods) in memory mapped segments,
+    kept in the directory <logfile without extension>.segments"""
+
+    def __init__(self, logfile="/tmp/parrotlogger.db", write_behind=False):
+        # Events are written to memory as they are logged, write_behind makes no difference
+        self.logfile = logfile
+        self.directory = os.path.splitext(logfile)[0] + '.segments'
+        self.started = time.strftime('%Y%m%dT%H%M%S')
+        if os.path.isdir(self.directory):
+            shutil.rmtree(self.directory)
+        os.makedirs(self.directory)
+        self.names = []        # id -> urn or category
+        self.name_ids = {}     # urn or category -> id
+        self.segments = []
+        self._segment_count = 0
+        self._last_id = 0
+        self._last_timestamp = 0
+        self.max_rows = self.max_bytes = self.max_age = self.archive = None
+        self.fulltext = False
+        self._new_segment()
+
+    def configure(self, max_rows=None, max_bytes=None, max_age=None, archive=None, fulltext=False):
+        """See Logger.configure(). Retention is enforced whenever a segment is
+        full, by dropping the oldest segments as long as the rest exceeds a limit.
+        Full-text queries are always possible, by scanning the messages."""
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.archive = archive
+        if archive and not os.path.isdir(archive):
+            os.makedirs(archive)
+        self.fulltext = fulltext
+        self._enforce()
+
+    def close(self):
+        for segment in self.segments:
+            segment.close()
+        self.segments = []
+
+    def flush(self):
+        # Everything logged is already in the segments
+        pass
+
+    def setlog(self, urn, msg, category=''):
+        """Log an event, and return it as a dict like the rows of getlog()."""
+        # Whole seconds (in ms), as in Logger
+        return self.append(int(time.time()) * 1000, str(urn), category, msg)
+
+    def append(self, timestamp, urn, category, msg):
+        """Log an event of the given time (ms), e.g. one moved from another log."""
+        # Clocks may step back, but timestamps must not for the time ranges to be ranges of rows
+        if timestamp < self._last_timestamp:
+            timestamp = self._last_timestamp
+        data = _encode(msg)[:SEGMENT_BYTES]
+        urn_id, cat_id = self._name_id(urn), self._name_id(category)
+        if not self.segments[-1].append(timestamp, urn_id, cat_id, data):
+            self._new_segment().append(timestamp, urn_id, cat_id, data)
+            self._enforce()
+        self._last_id += 1
+        self._last_timestamp = timestamp
+        return {'id': self._last_id, 'timestamp': timestamp, 'urn': urn, 'category': category, 'msg': msg}
+
+    def _name_id(self, name):
+        try:
+            return self.name_ids[name]
+        except KeyError:
+            self.name_ids[name] = len(self.names)
+            self.names.append(name)
+            return self.name_ids[name]
+
+    def _new_segment(self):
+        segment = Segment(os.path.join(self.directory, '%06d' % self._segment_count), self._last_id + 1)
+        self._segment_count += 1
+        self.segments.append(segment)
+        return segment
+
+    def _enforce(self):
+        while len(self.segments) > 1:
+            oldest, rest = self.segments[0], self.segments[1:]
+            last = oldest.timestamp(oldest.rows - 1) if oldest.rows else 0
+            if not ((self.max_rows and sum(s.rows for s in rest) >= self.max_rows) or
+                    (self.max_bytes and sum(s.size() for s in rest) >= self.max_bytes) or
+                    (self.max_age and last < (time.time() - self.max_age) * 1000)):
+                break
+            if self.archive:
+                self._archive(oldest)
+            oldest.close(remove=True)
+            self.segments = rest
+
+    def _archive(self, segment):
+        name = '%s-%s-%09d.jsonl.gz' % (os.path.splitext(os.path.basename(self.logfile))[0], self.started,
+                                        segment.first_id)
+        archive = gzip.open(os.path.join(self.archive, name), 'wb')
+        try:
+            for row in xrange(segment.rows):
+                archive.write(json.dumps(self._event(segment, row)) + '\n')
+        finally:
+            archive.close()
+
+    def _event(self, segment, row):
+        return {'id': segment.first_id + row,
+                'timestamp': segment.timestamp(row),
+                'urn': self.names[_URN.unpack_from(segment.cols, _URN_OFF + _URN.size * row)[0]],
+                'category': self.names[_CAT.unpack_from(segment.cols, _CAT_OFF + _CAT.size * row)[0]],
+                'msg': segment.message(row)}
+
+    def _ids(self, exact, like, pattern):
+        # Ids of the names matching all, None if there is no filter
+        tests = []
+        if exact:
+            tests.append(lambda name: name == exact)
+        if like:
+            tests.append(logger._like(like))
+        if pattern:
+            tests.append(logger._like('%' + pattern + '%'))
+        if not tests:
+            return None
+        return set(i for i, name in enumerate(self.names) if all(test(name) for test in tests))
+
+    def getlog(self, urn_filter=None, category_filter=None, timestamp_filter=None, msg_filter=None,
+               urn=None, category=None, msg=None, match=None, since=None, until=None, order='asc', limit=None, after=None,
+               urn_like=None, category_like=None):
+        """Get a list of events from the log, see Logger.getlog()."""
+        if order not in ('asc', 'desc'):
+            raise ValueError("Unknown log order '%s'" % order)
+        urn_ids = self._ids(urn, urn_like, urn_filter)
+        cat_ids = self._ids(category, category_like, category_filter)
+        # Tests of what is not in the columns
+        tests = []
+        for key, p in (('timestamp', timestamp_filter), ('msg', msg_filter), ('msg', msg)):
+            if p:
+                tests.append((key, logger._like('%' + p + '%')))
+        if match:
+            tests.append(('msg', logger._words(match)))
+        limit = int(limit) if limit is not None else None
+
+        events = []
+        segments = self.segments if order == 'asc' else reversed(self.segments)
+        for segment in segments:
+            if limit is not None and len(events) >= limit:
+                break
+            if not segment.rows:
+                continue
+            lo, hi = 0, segment.rows
+            if since is not None:
+                lo = segment.bisect(int(since))
+            if until is not None:
+                hi = segment.bisect(int(until))
+            if after is not None and order == 'asc':
+                lo = max(lo, int(after) - segment.first_id + 1)
+            elif after is not None:
+                hi = min(hi, int(after) - segment.first_id)
+            if lo >= hi:
+                continue
+            rows = segment.select(lo, hi, urn_ids, cat_ids)
+            if order == 'desc':
+                rows = reversed(rows)
+            for row in rows:
+                if limit is not None and len(events) >= limit:
+                    break
+                event = self._event(segment, row)
+                for key, test in tests:
+                    if not test(event[key]):
+                        break
+                else:
+                    events.append(event)
+        return events
@@ -0,0 +1,148 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""The log database as a process of its own, urn:logger.
+
+The Core dispatches it like the weblink and routes control messages to it:
+    set log           -- log the value (category in 'category', if any)
+    set log_filter    -- filter of the sender's 'get log', see Logger.getlog()
+    get log           -- reply with the log, the value (if any) adds to the filter
+    set log_subscribe -- push new events to the sender as 'log_append',
+                         value is True, a filter, or False to stop
+    set config        -- the "logger" section of the config, see Logger.configure(),
+                         "backend": "segments" logs to log_segments.SegmentLogger
+This keeps disk I/O and slow queries out of the Core's routing loop.
+"""
+
+import errno
+import select
+import sqlite3
+import logger
+import log_segments
+
+URN = 'urn:logger'
+
+# Keys of messages to the Core that are passed on to the log service
+LOG_KEYS = ('log', 'log_filter', 'log_subscribe')
+
+class LogService:
+
+    def __init__(self, logfile, ctrl):
+        self.logfile = logfile
+        self.logger = logger.Logger(logfile, write_behind=True)
+        self.ctrl = ctrl
+        self.filters = {}       # urn -> filter of its 'get log'
+        self.subscribers = {}   # urn -> filter (see logger.matcher()) of log events pushed to it
+        self.pushed = {}        # urn -> log events not yet pushed to it
+
+    def serve(self):
+        running = True
+        try:
+            while running:
+                # Not ctrl.poll(None), which doesn't let signals (Ctrl-C) through
+                try:
+                    select.select([self.ctrl], [], [])
+                except select.error, e:
+                    if e.args[0] != errno.EINTR:
+                        raise
+                    continue
+                # Handle all that is waiting, then push the new events in one message per subscriber
+                while running and self.ctrl.poll():
+                    try:
+                        msg = self.ctrl.recv()
+                    except EOFError:
+                        # The Core is gone
+                        running = False
+                        break
+                    running = self.control_message(msg)
+                if self.pushed:
+                    self.push_log()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.logger.close()
+
+    def control_message(self, msg):
+        """Handle msg, return False when it is time to stop."""
+        action, key = msg['action'], msg['key']
+        if action == 'set' and key == 'log':
+            event = self.logger.setlog(msg['sender'], msg['value'], msg.get('category', ''))
+            for urn, match in self.subscribers.iteritems():
+                if match(event):
+                    self.pushed.setdefault(urn, []).append(event)
+
+        elif action == 'set' and key == 'log_subscribe':
+            self.subscribers.pop(msg['sender'], None)
+            self.pushed.pop(msg['sender'], None)
+            log_filter = msg['value']
+            if log_filter is True:
+                log_filter = {}
+            if log_filter is not False and log_filter is not None:
+                try:
+                    self.subscribers[msg['sender']] = logger.matcher(**log_filter)
+                except (TypeError, ValueError), e:
+                    print "[Logger] Bad log filter %s: %s" % (log_filter, e)
+
+        elif action == 'set' and key == 'log_filter':
+            self.filters[msg['sender']] = msg['value']
+
+        elif action == 'get' and key == 'log':
+            log_filter = self.filters.get(msg['sender'], {})
+            try:
+                if isinstance(log_filter, dict):
+                    # The request may add to the filter, e.g. {'after': <id of last event seen>} to tail the log
+                    log = self.logger.getlog(**dict(log_filter, **(msg.get('value') or {})))
+                else:
+                    log = self.logger.getlog(*log_filter)
+            except (TypeError, ValueError), e:
+                print "[Logger] Bad log filter %s: %s" % (log_filter, e)
+                log = []
+            reply = {'dest':msg['sender'], 'sender':msg['dest'], 'action':'set', 'key':'log', 'value':log}
+            self.ctrl.send(reply)
+
+        elif action == 'set' and key == 'config':
+            config = dict(msg['value'])
+            if config.pop('backend', 'sqlite') == 'segments' and not isinstance(self.logger, log_segments.SegmentLogger):
+                self.use_segments()
+            try:
+                self.logger.configure(**config)
+            except (TypeError, OSError, sqlite3.Error), e:
+                print "[Logger] Bad logger config, logging without retention: %s" % e
+
+        elif action == 'set' and key == 'running':
+            return msg['value']
+
+        else:
+            print "[Logger] Unknown message: %s" % msg
+        return True
+
+    def use_segments(self):
+        """Switch to the columnar backend, keeping what has been logged."""
+        segments = log_segments.SegmentLogger(self.logfile)
+        for event in self.logger.getlog():
+            segments.append(event['timestamp'], event['urn'], event['category'], event['msg'])
+        self.logger.close()
+        self.logger = segments
+
+    def push_log(self):
+        """Send the log events gathered for each subscriber, in one message."""
+        for urn, events in self.pushed.iteritems():
+            msg = {'dest':urn, 'sender':URN, 'action':'set', 'key':'log_append', 'value':events}
+            self.ctrl.send(msg)
+        self.pushed = {}
+
+def create_log_service(logfile, ctrl):
+    LogService(logfile, ctrl).serve()
@@ -14,31 +14,369 @@
 #
 ########################################################################
 
+"""Log database of the Core.
+
+By default every log line is committed as it is logged. In write-behind mode
+log lines are queued in memory and a background thread inserts them in
+batches, one transaction per batch, so that logging never waits for the
+disk. getlog() flushes the queue first, so it always sees every line logged.
+
+A retention policy (see Logger.configure()) bounds the log by number of rows,
+size or age. It is enforced by a background thread that deletes the oldest
+rows in batches, optionally saving them to compressed archive files first.
+read_archive() queries archive files like getlog() queries the log, e.g.
+    "logger": {"max_age": 86400, "max_bytes": 100000000, "archive": "/tmp/parrotlog"}
+in the simulation config keeps a day (at most 100 MB) of log in the database,
+and archives older events to /tmp/parrotlog.
+"""
+
 import datetime
+import glob
+import gzip
+import json
+import os
+import re
+import threading
+import time
 import sqlite3 as lite
 
+# Write-behind: commit when this many lines are queued, or this many seconds after the first
+BATCH_SIZE = 1000
+BATCH_INTERVAL = 0.5
+
+# Retention: check the policy this often (seconds), delete at most this many rows per transaction
+RETENTION_INTERVAL = 5.0
+RETENTION_BATCH = 10000
+# Size the write-ahead log is truncated to after a checkpoint (write-behind)
+WAL_SIZE_LIMIT = 4 * 1024 * 1024
+
+_INSERT = "INSERT INTO Logger(rowid, Timestamp, Urn, Category, Msg) VALUES(?, ?, ?, ?, ?)"
+_EVENT_KEYS = ('id', 'timestamp', 'urn', 'category', 'msg')
+
+def _like(pattern):
+    """Return a test of values like the SQL 'LIKE pattern' (case insensitive ASCII)."""
+    parts = []
+    for c in pattern:
+        parts.append({'%': '.*', '_': '.'}.get(c) or re.escape(c))
+    match = re.compile(''.join(parts) + r'\Z', re.DOTALL | re.IGNORECASE).match
+    return lambda value: match('%s' % value) is not None
+
+def _tokens(text):
+    # Like the unicode61 tokenizer of FTS5, less folding of diacritics
+    return _token.findall(text.lower())
+
+_token = re.compile(r'[^\W_]+', re.UNICODE)
+_query_term = re.compile(r'"([^"]*)"|(\S+)')
+
+def _words(query):
+    """Return a test of messages like 'Msg MATCH query' for full-text queries
+    made of words, "phrases" and prefixes (word*), all of which must match.
+    Raise ValueError for other FTS5 query syntax."""
+    phrases = []
+    for phrase, bare in _query_term.findall(query):
+        if bare == 'AND':
+            continue
+        if bare in ('OR', 'NOT', 'NEAR') or re.search(r'[():^+{}]', bare):
+            raise ValueError("Full-text query '%s' is too complex, use words and \"phrases\"" % query)
+        text = phrase or bare
+        prefix = text.endswith('*')
+        words = _tokens(text)
+        if words:
+            phrases.append((words, prefix))
+
+    def test(value):
+        tokens = _tokens(u'%s' % value)
+        for words, prefix in phrases:
+            n = len(words)
+            for i in range(len(tokens) - n + 1):
+                if tokens[i:i + n - 1] == words[:-1] and (tokens[i + n - 1].startswith(words[-1]) if prefix
+                                                          else tokens[i + n - 1] == words[-1]):
+                    break
+            else:
+                return False
+        return True
+    return test
+
+def matcher(urn_filter=None, category_filter=None, timestamp_filter=None, msg_filter=None,
+            urn=None, category=None, msg=None, match=None, since=None, until=None, order='asc', limit=None, after=None,
+            urn_like=None, category_like=None):
+    """Return a function telling if an event (as returned by setlog()) passes
+    the filters, which are those of Logger.getlog(). Limit doesn't apply, order
+    only to the after cursor (events before it when 'desc'), and full-text
+    queries (match) are limited to words and phrases."""
+    tests = []
+    for key, p in (('timestamp', timestamp_filter), ('urn', urn_filter), ('category', category_filter),
+                   ('msg', msg_filter), ('msg', msg)):
+        if p:
+            tests.append((key, _like('%' + p + '%')))
+    for key, p in (('urn', urn), ('category', category)):
+        if p:
+            tests.append((key, lambda value, p=p: value == p))
+    for key, p in (('urn', urn_like), ('category', category_like)):
+        if p:
+            tests.append((key, _like(p)))
+    if match:
+        tests.append(('msg', _words(match)))
+    if since is not None:
+        tests.append(('timestamp', lambda value, since=int(since): value >= since))
+    if until is not None:
+        tests.append(('timestamp', lambda value, until=int(until): value < until))
+    if order not in ('asc', 'desc'):
+        raise ValueError("Unknown log order '%s'" % order)
+    if after is not None and order == 'asc':
+        tests.append(('id', lambda value, after=int(after): value > after))
+    elif after is not None:
+        tests.append(('id', lambda value, after=int(after): value < after))
+
+    def passes(event):
+        for key, test in tests:
+            if not test(event[key]):
+                return False
+        return True
+    return passes
+
+def read_archive(path, **filters):
+    """Return the archived events in path (an archive directory, file or glob
+    pattern) passing filters, the keyword filters of Logger.getlog()."""
+    if os.path.isdir(path):
+        path = os.path.join(path, '*.jsonl.gz')
+    match = matcher(**filters)
+    events = []
+    for filename in glob.glob(path):
+        archive = gzip.open(filename, 'rb')
+        try:
+            for line in archive:
+                event = json.loads(line)
+                if match(event):
+                    events.append(event)
+        finally:
+            archive.close()
+    events.sort(key=lambda event: event['id'], reverse=filters.get('order') == 'desc')
+    if filters.get('limit') is not None:
+        events = events[:int(filters['limit'])]
+    return events
+
 class Logger:
 
-    def __init__(self, logfile="/tmp/parrotlogger.db"):
+    def __init__(self, logfile="/tmp/parrotlogger.db", write_behind=False):
+        self.logfile = logfile
+        self.started = time.strftime('%Y%m%dT%H%M%S')
         self.conn = lite.connect(logfile)
         self.cur = self.conn.cursor()
+        self.cur.execute("DROP TABLE IF EXISTS LoggerText")
         self.cur.execute("DROP TABLE IF EXISTS Logger")
         self.cur.execute("CREATE TABLE Logger(Timestamp INT, Urn TEXT, Category TEXT, Msg TEXT)")
+        self.cur.execute("CREATE INDEX LoggerUrnTimestamp ON Logger(Urn, Timestamp)")
+        self.cur.execute("CREATE INDEX LoggerCategory ON Logger(Category)")
+        self.conn.commit()
+        # Ids (rowids) are given out here, so that they are known before the row is written
+        self._last_id = 0
+        self.fulltext = False
+        self.retention = None
+        self.writer = None
+        if write_behind:
+            # Readers don't block the writer (nor the other way around) in WAL mode
+            self.cur.execute("PRAGMA journal_mode=WAL").fetchall()
+            self._cond = threading.Condition()
+            self._queue = []
+            self._queued = 0        # Lines queued since start
+            self._written = 0       # Lines written since start
+            self._flushing = 0      # Threads waiting in flush()
+            self._closing = False
+            self.writer = threading.Thread(target=self._write_behind, name='Logger')
+            self.writer.daemon = True
+            self.writer.start()
+
+    def configure(self, max_rows=None, max_bytes=None, max_age=None, archive=None, fulltext=False):
+        """Set the retention policy, removing the oldest events when there are
+        more than max_rows, the database is larger than max_bytes, or they are
+        older than max_age seconds. If archive is a directory, removed events
+        are saved there in gzipped files of JSON lines (see read_archive()).
+        Without any limit, the log is kept as it is, i.e. grows without bound.
+        With fulltext set, messages are indexed for the match filter of getlog()."""
+        if fulltext and not self.fulltext:
+            self._create_fulltext()
+        self.max_rows = max_rows
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.archive = archive
+        if archive and not os.path.isdir(archive):
+            os.makedirs(archive)
+        if (max_rows or max_bytes or max_age) and not self.retention:
+            self._stopped = threading.Event()
+            self.retention = threading.Thread(target=self._retain, name='LoggerRetention')
+            self.retention.daemon = True
+            self.retention.start()
+
+    def _create_fulltext(self):
+        # An FTS5 index over Logger.Msg, kept in sync by triggers in whatever connection
+        # (write-behind, retention) changes the log. The text itself is only kept in Logger.
+        self.cur.execute("CREATE VIRTUAL TABLE LoggerText USING fts5(Msg, content='Logger')")
+        self.cur.execute("CREATE TRIGGER LoggerTextInsert AFTER INSERT ON Logger BEGIN "
+                         "INSERT INTO LoggerText(rowid, Msg) VALUES(new.rowid, new.Msg); END")
+        self.cur.execute("CREATE TRIGGER LoggerTextDelete AFTER DELETE ON Logger BEGIN "
+                         "INSERT INTO LoggerText(LoggerText, rowid, Msg) VALUES('delete', old.rowid, old.Msg); END")
+        # Index what was logged before
+        self.cur.execute("INSERT INTO LoggerText(LoggerText) VALUES('rebuild')")
+        self.conn.commit()
+        self.fulltext = True
 
     def close(self):
+        if self.retention:
+            self._stopped.set()
+            self.retention.join()
+            self.retention = None
+        if self.writer:
+            self._cond.acquire()
+            self._closing = True
+            self._cond.notify_all()
+            self._cond.release()
+            self.writer.join()
+            self.writer = None
         self.conn.close()
 
     def setlog(self, urn, msg, category=''):
-        log = (int(datetime.datetime.now().strftime("%s"))*1000, str(urn), category, msg)
-        self.cur.execute("INSERT INTO Logger VALUES(?, ?, ?, ?)", log)
-        self.conn.commit()
+        """Log an event, and return it as a dict like the rows of getlog()."""
+        if not self.writer:
+            self._last_id += 1
+            log = (self._last_id, int(datetime.datetime.now().strftime("%s"))*1000, str(urn), category, msg)
+            self.cur.execute(_INSERT, log)
+            self.conn.commit()
+            return dict(zip(_EVENT_KEYS, log))
+        self._cond.acquire()
+        try:
+            self._last_id += 1
+            log = (self._last_id, int(datetime.datetime.now().strftime("%s"))*1000, str(urn), category, msg)
+            self._queue.append(log)
+            self._queued += 1
+            if len(self._queue) == 1 or len(self._queue) >= BATCH_SIZE:
+                self._cond.notify_all()
+        finally:
+            self._cond.release()
+        return dict(zip(_EVENT_KEYS, log))
+
+    def flush(self):
+        """Wait until every line logged so far is in the database."""
+        if not self.writer:
+            return
+        self._cond.acquire()
+        try:
+            target = self._queued
+            self._flushing += 1
+            self._cond.notify_all()
+            while self._written < target and self.writer.is_alive():
+                self._cond.wait(BATCH_INTERVAL)
+            self._flushing -= 1
+        finally:
+            self._cond.release()
+
+    def _write_behind(self):
+        # The writer has a connection of its own, sqlite connections don't mix threads well
+        conn = lite.connect(self.logfile)
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA journal_size_limit=%d" % WAL_SIZE_LIMIT).fetchall()
+        cond = self._cond
+        while True:
+            cond.acquire()
+            try:
+                while not self._queue and not self._closing:
+                    cond.wait()
+                # Give the batch some time to fill up, unless someone is waiting for it
+                deadline = time.time() + BATCH_INTERVAL
+                while len(self._queue) < BATCH_SIZE and not (self._closing or self._flushing):
+                    timeout = deadline - time.time()
+                    if timeout <= 0:
+                        break
+                    cond.wait(timeout)
+                batch, self._queue = self._queue, []
+                closing = self._closing
+            finally:
+                cond.release()
+            if batch:
+                try:
+                    conn.executemany(_INSERT, batch)
+                    conn.commit()
+                except lite.Error, e:
+                    print '[Logger] Dropped %d log lines: %s' % (len(batch), e)
+            cond.acquire()
+            self._written += len(batch)
+            cond.notify_all()
+            cond.release()
+            if closing and not self._queue:
+                break
+        conn.close()
+
+    def _retain(self):
+        conn = lite.connect(self.logfile)
+        conn.execute("PRAGMA journal_size_limit=%d" % WAL_SIZE_LIMIT).fetchall()
+        while not self._stopped.is_set():
+            try:
+                self._enforce(conn)
+            except lite.Error, e:
+                print '[Logger] Retention failed: %s' % e
+            self._stopped.wait(RETENTION_INTERVAL)
+        conn.close()
+
+    def _enforce(self, conn):
+        """Remove (and archive) the events outside the retention policy, in batches."""
+        first, last = conn.execute("SELECT min(rowid), max(rowid) FROM Logger").fetchone()
+        if first is None:
+            return
+        # Rows are inserted in time order, so the rowids of the events to remove are <= cutoff
+        cutoff = first - 1
+        if self.max_rows:
+            cutoff = max(cutoff, last - self.max_rows)
+        if self.max_age:
+            young = int((time.time() - self.max_age) * 1000)
+            row = conn.execute("SELECT rowid FROM Logger WHERE Timestamp >= ? ORDER BY rowid LIMIT 1", (young,)).fetchone()
+            cutoff = max(cutoff, row[0] - 1 if row else last)
+        if self.max_bytes:
+            page_size, = conn.execute("PRAGMA page_size").fetchone()
+            pages, = conn.execute("PRAGMA page_count").fetchone()
+            free, = conn.execute("PRAGMA freelist_count").fetchone()
+            used = (pages - free) * page_size
+            if used > self.max_bytes:
+                # Deleted pages are reused rather than returned, so the file stays at about max_bytes
+                keep = (last - first + 1) * self.max_bytes // used
+                cutoff = max(cutoff, last - keep)
+        while first <= cutoff and not self._stopped.is_set():
+            end = min(cutoff, first + RETENTION_BATCH - 1)
+            if self.archive:
+                self._archive(conn, first, end)
+            conn.execute("DELETE FROM Logger WHERE rowid <= ?", (end,))
+            conn.commit()
+            first = end + 1
 
+    def _archive(self, conn, first, end):
+        name = '%s-%s-%09d.jsonl.gz' % (os.path.splitext(os.path.basename(self.logfile))[0], self.started, first)
+        archive = gzip.open(os.path.join(self.archive, name), 'wb')
+        try:
+            for row in conn.execute("SELECT rowid, * FROM Logger WHERE rowid BETWEEN ? AND ?", (first, end)):
+                archive.write(json.dumps(dict(zip(_EVENT_KEYS, row))) + '\n')
+        finally:
+            archive.close()
 
-    def getlog(self, urn_filter=None, category_filter=None, timestamp_filter=None, msg_filter=None):
+    def getlog(self, urn_filter=None, category_filter=None, timestamp_filter=None, msg_filter=None,
+               urn=None, category=None, msg=None, match=None, since=None, until=None, order='asc', limit=None, after=None,
+               urn_like=None, category_like=None):
         """Get a list of events from the log database. Optionally filtered using 
         <col> LIKE <filter>, where filter is an sqlite regexp with '%', '_', '[<range>]'
-        The return value is a list (possibly empty) with a dict for each row.""" 
+        The return value is a list (possibly empty) with a dict for each row.
 
+        The keyword filters make use of the indexes of the log:
+        urn, category -- exact match
+        urn_like, category_like -- LIKE pattern, e.g. 'urn:hodcp:node:%' (not indexed)
+        msg -- like msg_filter
+        match -- full-text query of the messages, e.g. 'timeout "connection refused" retr*'
+                 (FTS5 query syntax), if enabled by configure()
+        since, until -- events with since <= timestamp < until (in ms)
+        order -- 'asc' (oldest first, default) or 'desc' (newest first)
+        limit -- return at most limit events
+        after -- cursor, the 'id' of the last event of the previous page
+        Each row dict carries the 'id' of the event.
+        """ 
+
+        self.flush()
         qstr = ['timestamp', 'urn', 'category', 'msg']
         prop = [timestamp_filter, urn_filter, category_filter, msg_filter]
         filter = []
@@ -50,14 +388,58 @@ class Logger:
             filter.append('%s LIKE ?'%q)    
             relaxed_param = '%'+p+'%'
             filter_params += (relaxed_param,)
+
+        for q, p in (('urn', urn), ('category', category)):
+            if not p:
+                continue
+            filter.append('%s = ?'%q)
+            filter_params += (p,)
+        for q, p in (('urn', urn_like), ('category', category_like)):
+            if not p:
+                continue
+            filter.append('%s LIKE ?'%q)
+            filter_params += (p,)
+        if msg:
+            filter.append('msg LIKE ?')
+            filter_params += ('%'+msg+'%',)
+        if match:
+            if not self.fulltext:
+                raise ValueError('Full-text search of the log is not enabled')
+            filter.append('rowid IN (SELECT rowid FROM LoggerText WHERE LoggerText MATCH ?)')
+            filter_params += (match,)
+        if since is not None:
+            filter.append('timestamp >= ?')
+            filter_params += (int(since),)
+        if until is not None:
+            filter.append('timestamp < ?')
+            filter_params += (int(until),)
+
+        if order not in ('asc', 'desc'):
+            raise ValueError("Unknown log order '%s'" % order)
+        if after is not None:
+            filter.append('rowid %s ?' % ('>' if order == 'asc' else '<'))
+            filter_params += (int(after),)
         
         if filter:
             query = ' WHERE ' + ' AND '.join(filter)
+        # Rows are inserted in time order, so the rowid orders them as well as the timestamp
+        query += ' ORDER BY rowid ' + order.upper()
+        if limit is not None:
+            query += ' LIMIT ?'
+            filter_params += (int(limit),)
 
-        result = self.cur.execute('SELECT * FROM Logger'+query, filter_params)
+        try:
+            result = self.cur.execute('SELECT rowid, * FROM Logger'+query, filter_params)
+        except lite.OperationalError, e:
+            if not match:
+                raise
+            # Most likely a syntax error in the full-text query
+            raise ValueError("Bad full-text query '%s': %s" % (match, e))
 
         retval = []
         for row in result:
-            retval.append(dict(zip(qstr, row)))
+            event = dict(zip(qstr, row[1:]))
+            event['id'] = row[0]
+            retval.append(event)
             
-        return retval    
+        return retval
@@ -14,7 +14,20 @@
 #
 ########################################################################
 
-"""Protocol handler for socket connections."""
+"""Protocol handler for socket connections.
+
+Messages are encoded by a codec, selected per simulation by the
+'wire_protocol' entry of the config (see get_codec()). The module level
+functions implement the original text protocol.
+
+Socket and connection ids are integers <namespace[32]><counter[32]>, minted
+from an IdSpace. Every node and network of a simulation has a namespace of
+its own (see id_namespaces()), so ids are unique per run.
+"""
+
+import itertools
+import socket
+import struct
 
 LISTEN = 'LISTEN'
 CONNECT = 'CONNECT'
@@ -52,7 +65,7 @@ def build_message(op, **params):
             msg += b' '+arg
         elif type(arg) == unicode:
             msg += b' '+bytearray(arg, 'utf-8')
-        elif type(arg) == int:
+        elif type(arg) in (int, long):
             msg += b' '+str(arg)
         elif type(arg) == memoryview:
             msg += b' '+bytearray(arg)
@@ -62,13 +75,249 @@ def build_message(op, **params):
     
 
 def parse_message(msg):
+    if isinstance(msg, memoryview):
+        msg = msg.tobytes()
     op, args = tuple(msg.split(' ', 1))
     info = _op_table[op]
     nargs = len(info['arglist']) 
     values = args.split(' ', nargs-1)
     keys = info['arglist']
     params = dict(zip(keys, values))
+    params['id'] = int(params['id'])
+    if 'new_id' in params:
+        params['new_id'] = int(params['new_id'])
     # For convenience, store op in params too
     params['cmd'] = op
 
     return (op, params)
+
+
+# Longest message head (op and id) that split_message() looks at
+_MAX_HEAD = 64
+
+def split_message(msg, op):
+    """Return (id, payload) if msg is an op message with an id and a payload,
+    or None. The payload is a slice of msg, i.e. not copied or decoded."""
+    head = msg[:_MAX_HEAD]
+    if isinstance(head, memoryview):
+        head = head.tobytes()
+    start = len(op) + 1
+    if head[:start] != op + ' ':
+        return None
+    end = head.find(' ', start)
+    if end < 0:
+        return None
+    return (int(head[start:end]), msg[end + 1:])
+
+def message_prefix(op, id):
+    """Start of an op message with an id, up to the payload: build_message()
+    of the same op, id and payload is the prefix followed by the payload."""
+    return '%s %d ' % (op, id)
+
+def message_id(buf, start, end):
+    """Return the id of the message in buf[start:end], its second word."""
+    first = buf.find(' ', start, end) + 1
+    second = buf.find(' ', first, end)
+    if second < 0:
+        second = end
+    return int(buf[first:second])
+
+def message_op(msg):
+    """Return the op of msg without parsing the rest."""
+    head = msg[:16]
+    if isinstance(head, memoryview):
+        head = head.tobytes()
+    return str(head).split(' ', 1)[0]
+
+
+ID_COUNTER_BITS = 32
+
+class IdSpace:
+    """Source of the ids minted in one namespace, safe to share between threads."""
+
+    def __init__(self, namespace):
+        self.namespace = namespace
+        # Counting starts at 1, the id 0 is never used
+        self._next = itertools.count((namespace << ID_COUNTER_BITS) + 1).next
+
+    def new_id(self):
+        return self._next()
+
+def id_namespaces(config):
+    """Map the urn of each node and network of config to its id namespace.
+
+    Nodes are numbered from 1 in sort order, followed by the networks, so
+    that every backplane (shard or federated host) given the same config
+    agrees on them. The namespace 0 is left to channels not in the config."""
+    urns = sorted(config.get('nodes', {})) + sorted(config.get('networks', {}))
+    return dict((urn, i + 1) for i, urn in enumerate(urns))
+
+
+class TextCodec:
+    """The original protocol: space separated ASCII with decimal ids, e.g.
+        SEND 4294967298 Hello"""
+
+    name = 'text'
+
+    build_message = staticmethod(build_message)
+    parse_message = staticmethod(parse_message)
+    split_message = staticmethod(split_message)
+    message_prefix = staticmethod(message_prefix)
+    message_id = staticmethod(message_id)
+    message_op = staticmethod(message_op)
+
+
+# Binary protocol: <version[1]><opcode[1]> followed by the fixed fields of
+# the op in network byte order and then, for some ops, the payload.
+# Ids are unsigned 64 bit integers, addresses 4 byte IPv4. Other addresses
+# (IPv6, host names) can't be encoded, a simulation using them must use the
+# text protocol.
+BINARY_VERSION = 1
+
+_binary_ops = [
+    # op, opcode, fixed fields, struct format of the fixed fields
+    (LISTEN,   1, ['id', 'ip', 'port'], 'Q4sH'),
+    (CONNECT,  2, ['id', 'ip', 'port'], 'Q4sH'),
+    (ACCEPTED, 3, ['id'], 'Q'),
+    (NEW_CONN, 4, ['id', 'new_id'], 'QQ'),
+    (SEND,     5, ['id'], 'Q'),
+    (RECEIVED, 6, ['id'], 'Q'),
+    (DISCONN,  7, ['id'], 'Q'),
+    (RECDFROM, 8, ['id', 'dst_port', 'src_ip', 'src_port'], 'QH4sH'),
+    (RECVFROM, 9, ['id', 'ip', 'port'], 'Q4sH'),
+    (ACCEPT,  10, ['id'], 'Q'),
+    (SENDTO,  11, ['id', 'src_port', 'dst_ip', 'dst_port'], 'QH4sH'),
+    ]
+
+_ADDRESS_FIELDS = ('ip', 'src_ip', 'dst_ip')
+_ID_OFFSET = 2
+
+def _ipv4_address(address):
+    try:
+        return socket.inet_aton(address)
+    except socket.error:
+        raise ValueError("The binary wire protocol takes IPv4 addresses only, not '%s', "
+                         "use \"wire_protocol\": \"text\"" % address)
+
+def _binary_encoder(opcode, layout, fields, payload):
+    """Return a function packing a params dict into a message of one op."""
+    # Per field: convert the address, or take ids and ports given as strings
+    converters = [_ipv4_address if f in _ADDRESS_FIELDS else int for f in fields]
+    fields = zip(fields, converters)
+    pack = layout.pack
+
+    def encode(params):
+        head = pack(BINARY_VERSION, opcode, *[convert(params[f] or 0) if convert is int
+                                              else convert(params[f] or '0.0.0.0')
+                                              for f, convert in fields])
+        if not payload:
+            return head
+        data = params['payload']
+        if type(data) == unicode:
+            data = data.encode('utf-8')
+        elif type(data) == memoryview:
+            data = data.tobytes()
+        return head + data
+    return encode
+
+def _binary_decoder(op, layout, fields, payload):
+    """Return a function unpacking a message of one op into (op, params)."""
+    addresses = [i for i, f in enumerate(fields) if f in _ADDRESS_FIELDS]
+    unpack_from = layout.unpack_from
+    size = layout.size
+
+    def decode(msg):
+        values = unpack_from(msg)[2:]
+        if addresses:
+            values = list(values)
+            for i in addresses:
+                values[i] = socket.inet_ntoa(values[i])
+        params = dict(zip(fields, values))
+        if payload:
+            data = msg[size:]
+            if type(data) == memoryview:
+                data = data.tobytes()
+            elif type(data) != str:
+                data = str(data)
+            params['payload'] = data
+        params['cmd'] = op
+        return (op, params)
+    decode.op = op
+    return decode
+
+class BinaryCodec:
+    """Compact protocol with integer opcodes and ids and fixed struct layouts.
+    Ports and ids are passed as integers. Addresses must be IPv4, building
+    a message with any other raises ValueError."""
+
+    name = 'binary'
+
+    def __init__(self):
+        self._encoders = {}
+        self._decoders = {}
+        self._layouts = {}
+        for op, opcode, fields, layout in _binary_ops:
+            layout = struct.Struct('!BB' + layout)
+            payload = 'payload' in _op_table[op]['arglist']
+            self._layouts[op] = (opcode, layout)
+            self._encoders[op] = _binary_encoder(opcode, layout, fields, payload)
+            self._decoders[opcode] = _binary_decoder(op, layout, fields, payload)
+        self._head = struct.Struct('!BB')
+        self._id = struct.Struct('!Q')
+
+    def build_message(self, op, **params):
+        return self._encoders[op](params)
+
+    def parse_message(self, msg):
+        version, opcode = self._head.unpack_from(msg)
+        if version != BINARY_VERSION:
+            raise ValueError('Unsupported binary message version %d' % version)
+        return self._decoders[opcode](msg)
+
+    def split_message(self, msg, op):
+        """Return (id, payload) if msg is an op message (with the layout of
+        SEND: an id followed by the payload), or None."""
+        opcode, layout = self._layouts[op]
+        if len(msg) < layout.size:
+            return None
+        version, code, id = layout.unpack_from(msg)
+        if version != BINARY_VERSION or code != opcode:
+            return None
+        return (id, msg[layout.size:])
+
+    def message_prefix(self, op, id):
+        opcode, layout = self._layouts[op]
+        return layout.pack(BINARY_VERSION, opcode, id)
+
+    def message_id(self, buf, start, end):
+        return self._id.unpack_from(buf, start + _ID_OFFSET)[0]
+
+    def message_op(self, msg):
+        if len(msg) < _ID_OFFSET:
+            return None
+        decoder = self._decoders.get(self._head.unpack_from(msg)[1])
+        return decoder and decoder.op
+
+
+TEXT = TextCodec()
+BINARY = BinaryCodec()
+CODECS = {TEXT.name: TEXT, BINARY.name: BINARY}
+
+def get_codec(name):
+    """Return the codec called name, i.e. 'text' (default) or 'binary'."""
+    if name not in CODECS:
+        raise ValueError("Unknown wire protocol '%s'" % name)
+    return CODECS[name]
+
+def non_ipv4_address(config):
+    """Return an interface address of config that BINARY can't carry, or None."""
+    for node_config in config.get('nodes', {}).itervalues():
+        for interface in node_config.get('interfaces', {}).itervalues():
+            address = interface.get('ip')
+            if address is None:
+                continue
+            try:
+                _ipv4_address(address)
+            except ValueError:
+                return address
+    return None
@@ -24,13 +24,15 @@ import threading
 import importlib
 import sys
 from comm_chan import CommChan
+import log_limits
 
-def create_node(config, urn, conn):
+def create_node(config, urn, transport, conn):
     """Dynamically instantiate a node by name.
 
     Arguments:
     config -- node config containing at least the name of the module to load
     urn -- the Uniform Resource Name assigned to the node
+    transport -- the comm_chan.Transport used to reach the backplane
     conn -- a pipe to communicate with the platform Core
 
     """
@@ -62,9 +64,10 @@ def create_node(config, urn, conn):
         print '[Core] Cannot find class <', node_class_name, '>\n'
     else:
         node = klass(urn, conn)
+        node.set_log_limits(config.get('log_limits'))
         node.configure(config)
         node.configure_interfaces(config)
-        node.connect_to_backplane(1111)
+        node.connect_to_backplane(transport)
         node.startControlChannel() ## Main event loop
 
 def locate_firmware(fw):
@@ -117,20 +120,30 @@ class Node:
         self.inputs = []
         self.state = {'capabilities': { 'logging': { 'type': 'boolean' }}}
         self.state['logging'] = True
+        self.log_limiter = log_limits.LogLimiter()
 
-    def log(self, msg):
+    def log(self, msg, category=''):
         """Add a log entry of the form <timestamp> <urn> <msg> to the log database."""
 
-        if self.state['logging']:
+        if self.state['logging'] and self.log_limiter.allow(self.urn, category):
             # Since msg may be binary, take some precautions:
             emsg = msg.decode('raw_unicode_escape')
             print("[%s] %s" % (self.urn, emsg))
             # Log msg format: {category.subcat.subsubcat (message)}
-            response = {'dest':'urn:hodcp:core', 'sender':self.urn, 'action':'set', 'key':'log', 'value':emsg}
+            response = {'dest':'urn:logger', 'sender':self.urn, 'action':'set', 'key':'log', 'value':emsg}
+            if category:
+                response['category'] = category
             self.conn.send(response)
         else:
             pass
 
+    def set_log_limits(self, config):
+        """Rate limits and sampling of log(), see log_limits.py"""
+        try:
+            self.log_limiter.configure(config)
+        except ValueError, e:
+            print("[%s] %s" % (self.urn, e))
+
     def deactivate(self):
         """Called when the node should stop. Implement in subclass if needed."""
         pass
@@ -178,11 +191,16 @@ class Node:
                 else:
                     self.deactivate()
                     self.done = True
+            elif key == 'log_limits':
+                self.set_log_limits(params['value'])
             else:
                 self.set(key, params['value'], params['sender'])
 
         elif op == 'get':
-            value = self.get(key)
+            if key in log_limits.KEYS:
+                value = self.log_limiter.get(key)
+            else:
+                value = self.get(key)
             if value == None:
                 return
             response = {'dest':params['sender'], 'sender':self.urn, 'action':'set', 'key':key, 'value':value}
@@ -197,7 +215,11 @@ class Node:
         self.inputs.append(ctrl)
         running = True
         while running:
-            inputready, _, _ = select.select(self.inputs,[],[])
+            # The comm channel may hold more than it handled at once
+            pending = self.comm_chan in self.inputs and self.comm_chan.input_pending()
+            inputready, _, _ = select.select(self.inputs,[],[], 0 if pending else None)
+            if pending and self.comm_chan not in inputready:
+                inputready.append(self.comm_chan)
 
             for s in inputready:
 
@@ -208,14 +230,14 @@ class Node:
                     else:
                         self.control(msg)
                 elif s == self.comm_chan:
-                    self.comm_chan.recv_cmd()
+                    if not self.comm_chan.recv_cmd():
+                        self.inputs.remove(s)
                 else:
                     self.log("Unknown socket: %s" % s)
 
     # REVISION: Shouldn't have to expose comm chan internals
-    def connect_to_backplane(self, port):
-        host = ''
-        cc = CommChan(host, port, self.urn)
+    def connect_to_backplane(self, transport):
+        cc = CommChan(transport, self.urn)
         self.comm_chan = cc
         # Add comm_chan to select list
         self.inputs.append(cc)
@@ -37,7 +37,7 @@ class Device:
 
     def _set_data(self, data, sender=None):
         # print '[ParrotDevice] _set_data: %s' % data
-        self.queue.put(data)
+        self.queue.put(data.tobytes())
 
     def open(self):
         """Open the device for reading and writing."""
@@ -15,7 +15,6 @@
 ########################################################################
 
 import socket
-import uuid
 import random
 import Queue
 from parrot.core import networking
@@ -85,6 +84,7 @@ class StreamSocket(object):
         self._type = type
         self._proto = proto
         self.comm_chan = node.comm_chan
+        self.codec = self.comm_chan.codec
         self.ip = "0.0.0.0"
         self.port = None
         self.pending_op = None
@@ -92,16 +92,15 @@ class StreamSocket(object):
         self.queue = Queue.Queue()
 
         self.name = kwargs.get('iface_name', 'UNASSIGNED')
-        new_uuid = str(uuid.uuid4())
-        self.id = kwargs.get('id', new_uuid)
         # is_connect_event implies socket was created in response to a CONNECT
-        is_connect_event = (self.id != new_uuid)
+        is_connect_event = 'id' in kwargs
+        self.id = kwargs['id'] if is_connect_event else self.comm_chan.ids.new_id()
 
         # NB. While it's OK to register a serial device as ser0, ser1, etc.,
         #     that is NOT possible for sockets, so we use the id instead.
         self.comm_chan.register_handler_for_interface(self.id, self._set_data)
         if is_connect_event:
-            msg = networking.build_message(networking.ACCEPT, id=self.id)
+            msg = self.codec.build_message(networking.ACCEPT, id=self.id)
             self.comm_chan.send_cmd(msg, self)
         # print '[ParrotSocket %s] __init__: ' % (self.id)
 
@@ -153,7 +152,7 @@ class StreamSocket(object):
 
     def fileno(self):
         """Return an integer unique to each socket."""
-        return uuid.UUID(self.id).int
+        return self.id
 
     def _assign_port(self):
         port = random.randint(1024, 65535)
@@ -161,7 +160,7 @@ class StreamSocket(object):
 
     def _set_data(self, data, sender=None):
         # print '[ParrotSocket %s] _set_data: %s' % (self.id, data)
-        self.queue.put(data)
+        self.queue.put(data.tobytes())
 
     def bind(self, address):
         """Bind the socket to address.
@@ -188,7 +187,7 @@ class StreamSocket(object):
     def listen(self, backlog=5):
         """Listen for connections made to the socket. The `backlog` argument is currently unused."""
         # FIXME: backlog
-        msg = networking.build_message(networking.LISTEN, id=self.id, ip=self.ip, port=self.port)
+        msg = self.codec.build_message(networking.LISTEN, id=self.id, ip=self.ip, port=self.port)
         self.comm_chan.send_cmd(msg, self)
 
     def accept(self):
@@ -198,7 +197,7 @@ class StreamSocket(object):
         The return value is a new socket object usable to send and receive data on the connection.
         """
         message = self.queue.get()
-        op, params = networking.parse_message(message)
+        op, params = self.codec.parse_message(message)
         if not op == networking.NEW_CONN:
             # print '[ParrotSocket %s] accept: Expected NEW_CONN, got: %s' % (self.id, message)
             return None
@@ -208,19 +207,19 @@ class StreamSocket(object):
     def connect(self, address):
         """Connect to an address where `address` is a tuple of (ip, port)."""
         self.name = self.interface_lookup(address[0]);
-        message = networking.build_message(networking.CONNECT, id=self.id, ip=address[0], port=address[1])
+        message = self.codec.build_message(networking.CONNECT, id=self.id, ip=address[0], port=address[1])
         # print '[ParrotSocket %s] connect: %s (%s)' % (self.id, message, self.name)
         self.comm_chan.send_cmd(message, self)
         # Block here waiting for ACCEPT from server
         message = self.queue.get()
 
-        op, params = networking.parse_message(message)
+        op, params = self.codec.parse_message(message)
         if op != networking.ACCEPTED or params['id'] != self.id:
             raise SocketException("Failed in connecting")
 
     def send(self, msg):
         """Send message (TCP)."""
-        message = networking.build_message(networking.SEND, id=self.id, payload=msg)
+        message = self.codec.build_message(networking.SEND, id=self.id, payload=msg)
         # print '[ParrotSocket %s] send: %s' % (self.id, message)
         self.comm_chan.send_cmd(message, self)
 
@@ -243,7 +242,7 @@ class StreamSocket(object):
     def recv(self, n=1):
         """Receive data from the socket. The return value is a string representing the data received."""
         message = self.queue.get()
-        op, params = networking.parse_message(message)
+        op, params = self.codec.parse_message(message)
         if not op == 'RECEIVED':
             if op == 'DISCONN':
                 self.close()
@@ -256,7 +255,7 @@ class StreamSocket(object):
         """Close the socket."""
         if self.comm_chan.has_registered_handler(self.id):
             # self._dump_queue()
-            message = networking.build_message(networking.DISCONN, id=self.id)
+            message = self.codec.build_message(networking.DISCONN, id=self.id)
             self.comm_chan.send_cmd(message, self)
             self.comm_chan.unregister_handler_for_interface(self.id)
 
@@ -295,7 +294,7 @@ class DatagramSocket(StreamSocket):
                 raise SocketException("Parrot UDP socket has no assigned port")
             else:
                 self._assign_port()
-        message = networking.build_message(networking.RECVFROM, id=self.id, ip=self.ip, port=self.port)
+        message = self.codec.build_message(networking.RECVFROM, id=self.id, ip=self.ip, port=self.port)
         self.comm_chan.send_cmd(message, self)
 
     def recvfrom(self, dummy):
@@ -310,7 +309,7 @@ class DatagramSocket(StreamSocket):
         self._become_active_listener()
 
         message = self.queue.get()
-        op, params = networking.parse_message(message)
+        op, params = self.codec.parse_message(message)
         if not op == 'RECDFROM':
             if op == 'DISCONN':
                 self.comm_chan.unregister_handler_for_interface(self.id)
@@ -323,6 +322,6 @@ class DatagramSocket(StreamSocket):
         """Send `data` (UDP) to an `address` which is a tuple of (ip, port)."""
         if not self.port:
             self._assign_port()
-        message = networking.build_message(networking.SENDTO, id=self.id, src_port=self.port, dst_ip=address[0], dst_port=address[1], payload=data)
+        message = self.codec.build_message(networking.SENDTO, id=self.id, src_port=self.port, dst_ip=address[0], dst_port=address[1], payload=data)
         # print '[ParrotSocket %s] send: %s' % (self.id, message)
         self.comm_chan.send_cmd(message, self)
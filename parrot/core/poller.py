@@ -0,0 +1,189 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""Event loop helper with persistent registration.
+
+Objects (sockets, pipes, comm channels, ...) with a fileno() method are
+registered once, and poll() returns only the objects that are ready. Uses
+epoll where available, then poll, and falls back to select."""
+
+import errno
+import select
+
+READ = 1
+WRITE = 2
+
+class Poller:
+
+    def __init__(self):
+        self._objects = {}      # Mapping fd to (object, events)
+        self._ready = set()     # Objects readable whatever the fd says, see ready()
+        if hasattr(select, 'epoll'):
+            self._impl = _EpollImpl()
+        elif hasattr(select, 'poll'):
+            self._impl = _PollImpl()
+        else:
+            self._impl = _SelectImpl()
+
+    def __len__(self):
+        return len(self._objects)
+
+    def register(self, obj, events=READ):
+        fd = obj.fileno()
+        if fd in self._objects:
+            raise KeyError("%s (fd %d) is already registered" % (obj, fd))
+        self._objects[fd] = (obj, events)
+        self._impl.register(fd, events)
+
+    def modify(self, obj, events):
+        fd = obj.fileno()
+        if self._objects[fd][1] != events:
+            self._objects[fd] = (obj, events)
+            self._impl.modify(fd, events)
+
+    def unregister(self, obj):
+        """Unregister obj, call before closing it."""
+        fd = obj.fileno()
+        del self._objects[fd]
+        self._impl.unregister(fd)
+        self._ready.discard(obj)
+
+    def ready(self, obj):
+        """Have the next poll() return registered obj as readable, without
+        waiting, e.g. when it holds more input than it handled at once."""
+        self._ready.add(obj)
+
+    def update(self, obj, events):
+        """Register, modify or (events is 0) unregister obj, whichever is needed."""
+        registered = obj.fileno() in self._objects
+        if not events:
+            if registered:
+                self.unregister(obj)
+        elif registered:
+            self.modify(obj, events)
+        else:
+            self.register(obj, events)
+
+    def poll(self, timeout=None):
+        """Return a list of (object, events) for registered objects that are ready.
+        Block at most timeout seconds, or forever if timeout is None."""
+        marked, self._ready = self._ready, set()
+        try:
+            ready = self._impl.poll(0 if marked else timeout)
+        except (IOError, OSError, select.error), e:
+            if e.args[0] != errno.EINTR:
+                raise
+            ready = []
+        objects = self._objects
+        result = [(objects[fd][0], events) for fd, events in ready if fd in objects]
+        for obj in marked.difference(obj for obj, events in result):
+            result.append((obj, READ))
+        return result
+
+class _EpollImpl:
+    def __init__(self):
+        self._epoll = select.epoll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.EPOLLIN
+        if events & WRITE:
+            mask |= select.EPOLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self._epoll.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self._epoll.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self._epoll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is None:
+            timeout = -1
+        ready = []
+        for fd, mask in self._epoll.poll(timeout):
+            events = 0
+            # Errors and hangups are reported as readable, the reader will find out
+            if mask & (select.EPOLLIN | select.EPOLLERR | select.EPOLLHUP):
+                events |= READ
+            if mask & select.EPOLLOUT:
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+class _PollImpl:
+    def __init__(self):
+        self._poll = select.poll()
+
+    def _mask(self, events):
+        mask = 0
+        if events & READ:
+            mask |= select.POLLIN
+        if events & WRITE:
+            mask |= select.POLLOUT
+        return mask
+
+    def register(self, fd, events):
+        self._poll.register(fd, self._mask(events))
+
+    def modify(self, fd, events):
+        self._poll.modify(fd, self._mask(events))
+
+    def unregister(self, fd):
+        self._poll.unregister(fd)
+
+    def poll(self, timeout):
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        ready = []
+        for fd, mask in self._poll.poll(timeout):
+            events = 0
+            if mask & (select.POLLIN | select.POLLERR | select.POLLHUP):
+                events |= READ
+            if mask & select.POLLOUT:
+                events |= WRITE
+            ready.append((fd, events))
+        return ready
+
+class _SelectImpl:
+    def __init__(self):
+        self._readers = set()
+        self._writers = set()
+
+    def register(self, fd, events):
+        if events & READ:
+            self._readers.add(fd)
+        if events & WRITE:
+            self._writers.add(fd)
+
+    def modify(self, fd, events):
+        self.unregister(fd)
+        self.register(fd, events)
+
+    def unregister(self, fd):
+        self._readers.discard(fd)
+        self._writers.discard(fd)
+
+    def poll(self, timeout):
+        rd, wr, _ = select.select(self._readers, self._writers, [], timeout)
+        ready = dict((fd, READ) for fd in rd)
+        for fd in wr:
+            ready[fd] = ready.get(fd, 0) | WRITE
+        return ready.items()
@@ -0,0 +1,110 @@
+# -*- Mode: python; tab-width: 4; indent-tabs-mode:nil; -*-
+# vim: tabstop=4 expandtab shiftwidth=4 softtabstop=4
+
+########################################################################
+# Copyright (c) 2013 Ericsson AB
+#
+# All rights reserved. This program and the accompanying materials
+# are made available under the terms of the Eclipse Public License v1.0
+# which accompanies this distribution, and is available at
+# http://www.eclipse.org/legal/epl-v10.html
+#
+# Contributors:
+#    Ericsson Research - initial implementation
+#
+########################################################################
+
+"""Partitioning of a simulation config over several backplane processes.
+
+Nodes that share a network, directly or through other nodes, or that are
+connected by a serial link must be relayed by the same backplane. Such groups
+of nodes are independent of each other, so each shard gets a subset of them
+together with their networks and links, and every node talks to exactly one
+shard. Enable with e.g.
+    "backplane": {"shards": 4}
+"""
+
+import os
+import comm_chan
+import networking
+
+# Distance between the TCP ports of consecutive shards, clear of the weblink port
+PORT_STRIDE = 100
+
+def shard_count(config):
+    """Number of backplane shards asked for by config, at least 1."""
+    return max(1, int(config.get('backplane', {}).get('shards', 1)))
+
+def components(config):
+    """Return the groups of node urns that must share a backplane, largest first."""
+    parent = {}
+
+    def find(x):
+        parent.setdefault(x, x)
+        while parent[x] != x:
+            parent[x] = parent[parent[x]]
+            x = parent[x]
+        return x
+
+    def union(a, b):
+        a, b = find(a), find(b)
+        if a != b:
+            parent[max(a, b)] = min(a, b)
+
+    for node_urn, node_config in config['nodes'].iteritems():
+        find(node_urn)
+        for if_conf in node_config.get('interfaces', {}).values():
+            network = if_conf.get('network')
+            if network:
+                union(node_urn, 'network ' + network)
+    for src, dst in config.get('links', {}).iteritems():
+        union(src.rpartition(':')[0], dst.rpartition(':')[0])
+
+    groups = {}
+    for node_urn in config['nodes']:
+        groups.setdefault(find(node_urn), []).append(node_urn)
+    return sorted((sorted(g) for g in groups.values()), key=lambda g: (-len(g), g[0]))
+
+def partition(config, count):
+    """Split config into at most count shard configs with a balanced number of nodes.
+
+    Each shard config is a copy of config restricted to its nodes, networks
+    and links, with a transport of its own."""
+    loads = [[] for i in range(count)]
+    for group in components(config):
+        min(loads, key=len).extend(group)
+
+    networks = config.get('networks', {})
+    links = config.get('links', {})
+    namespaces = networking.id_namespaces(config)
+    shards = []
+    for node_urns in loads:
+        if not node_urns:
+            continue
+        nodes = dict((urn, config['nodes'][urn]) for urn in node_urns)
+        used = set(if_conf.get('network') for node_config in nodes.values()
+                   for if_conf in node_config.get('interfaces', {}).values())
+        shard = dict(config)
+        shard['nodes'] = nodes
+        shard['networks'] = dict((urn, nw) for urn, nw in networks.iteritems() if urn in used)
+        shard['links'] = dict((src, dst) for src, dst in links.iteritems()
+                              if src.rpartition(':')[0] in nodes)
+        shard['transport'] = shard_transport(config, len(shards))
+        shard['id_namespaces'] = namespaces
+        shards.append(shard)
+    return shards
+
+def shard_transport(config, index):
+    """Transport parameters of shard index: TCP ports and unix socket paths
+    are made unique per shard, other transports are per-node anyway."""
+    params = config.get('transport', {})
+    if isinstance(params, basestring):
+        params = {'type': params}
+    params = dict(params)
+    kind = params.get('type', 'tcp')
+    if kind == 'tcp':
+        params['port'] = params.get('port', 1111) + PORT_STRIDE * index
+    elif kind == 'unix':
+        path = params.get('path', comm_chan.DEFAULT_UNIX_PATH % os.getpid())
+        params['path'] = '%s.%d' % (path, index)
+    return params
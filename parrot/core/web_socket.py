@@ -35,7 +35,7 @@
 # Specifications conformation: http://tools.ietf.org/html/rfc6455
 # The rfc6455 frame operation code is based on code from pywebsocket (http://code.google.com/p/pywebsocket/)
 
-import array, struct
+import binascii, errno, os, socket, struct, zlib
 from base64 import b64encode
 from hashlib import sha1
 from mimetools import Message
@@ -47,11 +47,21 @@ Upgrade: websocket\r
 Connection: Upgrade\r
 Sec-WebSocket-Accept: %s\r
 Sec-WebSocket-Protocol: base64\r
-\r
+%s\r
 """
 
 MAGICAL_STRING = "258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
 
+# Bytes read from a socket at a time, at most, before others get their turn
+MAX_READ = 1024 * 1024
+# Largest message received, larger ones close the connection
+MAX_MESSAGE_SIZE = 64 * 1024 * 1024
+# Largest opening handshake
+MAX_HANDSHAKE_SIZE = 16 * 1024
+
+# Appended to a deflated message by a sync flush, not sent (RFC 7692 7.2.1)
+_DEFLATE_TAIL = '\x00\x00\xff\xff'
+
 # Frame opcodes defined in the spec.
 OPCODE_CONTINUATION = 0x0
 OPCODE_TEXT = 0x1
@@ -59,9 +69,6 @@ OPCODE_BINARY = 0x2
 OPCODE_CLOSE = 0x8
 OPCODE_PING = 0x9
 OPCODE_PONG = 0xa
-# Not really defined in the spec. For abrupt termination from the client
-# during page refresh or tab/browser close in Chrome
-OPCODE_ABRUPT = 0xf
 # Status codes
 # Code STATUS_NO_STATUS_RECEIVED, STATUS_ABNORMAL_CLOSURE, and
 # STATUS_TLS_HANDSHAKE are pseudo codes to indicate specific error cases.
@@ -114,19 +121,18 @@ class RepeatedXorMasker(object):
         self._count = 0
 
     def mask(self, s):
-        result = array.array('B')
-        result.fromstring(s)
-        # Use temporary local variables to eliminate the cost to access
-        # attributes
+        # XOR all of s at once as one long integer, rather than byte by byte
+        length = len(s)
+        if not length:
+            return s
         count = self._count
-        mask = self._mask
-        mask_size = self._mask_size
-        for i in xrange(len(result)):
-            result[i] ^= mask[count]
-            count = (count + 1) % mask_size
-        self._count = count
+        mask = ''.join(map(chr, self._mask[count:] + self._mask[:count]))
+        mask = (mask * (length // self._mask_size + 1))[:length]
+        self._count = (count + length) % self._mask_size
 
-        return result.tostring()
+        result = (int(binascii.hexlify(s), 16) ^
+                  int(binascii.hexlify(mask), 16))
+        return binascii.unhexlify('%0*x' % (2 * length, result))
 
 class Frame(object):
 
@@ -288,6 +294,155 @@ def create_close_frame(body, mask=False):
 def _is_control_opcode(opcode):
     return (opcode >> 3) == 1
 
+# Returned by wsclient._receive_frame() for a frame that completes no message
+_NO_MESSAGE = object()
+
+class PerMessageDeflate(object):
+    """The permessage-deflate extension (RFC 7692) as negotiated with a
+    client. Messages to the client are deflated with a window of
+    window_bits, keeping the context from one message to the next if
+    context_takeover; see negotiate_deflate(). Messages from the client are
+    inflated keeping the context unless client_context_takeover is False.
+    """
+
+    def __init__(self, window_bits=15, context_takeover=True,
+                 client_context_takeover=True):
+        self.window_bits = window_bits
+        self.context_takeover = context_takeover
+        self.client_context_takeover = client_context_takeover
+        self._compressor = None
+        self._decompressor = None
+
+    def frame(self, payload):
+        """Create a text frame of payload, deflated."""
+
+        compressor = self._compressor
+        if compressor is None:
+            compressor = zlib.compressobj(
+                zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -self.window_bits)
+            if self.context_takeover:
+                self._compressor = compressor
+        data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+        data = data[:-len(_DEFLATE_TAIL)]
+        if not self.context_takeover and len(data) >= len(payload):
+            # Not worth it, and nothing to keep in step with
+            return create_binary_frame(payload, OPCODE_TEXT)
+        header = create_header(OPCODE_TEXT, len(data), 1, 1, 0, 0, False)
+        return header + data
+
+    def inflate(self, data):
+        """Inflate a message received from the client.
+
+        Raises:
+            InvalidFrameException: when data is not deflated or inflates
+                to more than MAX_MESSAGE_SIZE.
+        """
+
+        decompressor = self._decompressor
+        if decompressor is None:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            message = decompressor.decompress(
+                data + _DEFLATE_TAIL, MAX_MESSAGE_SIZE + 1)
+        except zlib.error, e:
+            raise InvalidFrameException('Bad deflated message: %s' % e)
+        # A message may end with a final block, which ends the context too
+        # (the tail is then left over)
+        if self.client_context_takeover and not decompressor.unused_data:
+            self._decompressor = decompressor
+        else:
+            self._decompressor = None
+        if len(message) > MAX_MESSAGE_SIZE:
+            raise InvalidFrameException(
+                'Message is larger than %d bytes' % MAX_MESSAGE_SIZE)
+        return message
+
+def _parse_extensions(header):
+    """Parse a Sec-WebSocket-Extensions header into a list of
+    (name, [(param, value or None), ...])."""
+
+    extensions = []
+    for offer in header.split(','):
+        parts = [part.strip() for part in offer.split(';')]
+        params = []
+        for param in parts[1:]:
+            name, sep, value = param.partition('=')
+            params.append((name.strip(), value.strip().strip('"') if sep else None))
+        extensions.append((parts[0], params))
+    return extensions
+
+def negotiate_deflate(header, window_bits=15, context_takeover=True):
+    """Accept the first permessage-deflate offer of a Sec-WebSocket-Extensions
+    header that we can, with a window of at most window_bits (9 to 15) and
+    context takeover if both we and the client want it.
+
+    Returns:
+        (PerMessageDeflate, Sec-WebSocket-Extensions header of the response),
+        or (None, None) when no offer is acceptable.
+    """
+
+    for name, params in _parse_extensions(header or ''):
+        if name != 'permessage-deflate':
+            continue
+        names = [param for param, value in params]
+        if len(set(names)) != len(names):
+            continue
+        bits = window_bits
+        takeover = context_takeover
+        client_takeover = True
+        try:
+            for param, value in params:
+                if param == 'server_no_context_takeover' and value is None:
+                    takeover = False
+                elif param == 'server_max_window_bits':
+                    # zlib can't deflate with a window of 8 bits
+                    if not value.isdigit() or not 9 <= int(value) <= 15:
+                        raise ValueError(value)
+                    bits = min(bits, int(value))
+                elif param == 'client_max_window_bits':
+                    # We inflate with any window
+                    if value is not None and not (value.isdigit() and 8 <= int(value) <= 15):
+                        raise ValueError(value)
+                elif param == 'client_no_context_takeover' and value is None:
+                    client_takeover = False
+                else:
+                    raise ValueError(param)
+        except (ValueError, AttributeError):
+            continue
+        response = 'permessage-deflate'
+        if not takeover:
+            response += '; server_no_context_takeover'
+        if bits < 15:
+            response += '; server_max_window_bits=%d' % bits
+        if not client_takeover:
+            response += '; client_no_context_takeover'
+        return PerMessageDeflate(bits, takeover, client_takeover), response
+    return None, None
+
+class SharedTextFrame(object):
+    """A text message to be sent to several clients (see wsclient.send_frame()).
+    It is framed once for the clients not deflating, and once for each window
+    of those deflating without context takeover.
+    """
+
+    def __init__(self, message):
+        self.payload = message.encode('utf-8')
+        self._frames = {}     # window bits or None -> frame
+
+    def __len__(self):
+        return len(self.payload)
+
+    def frame(self, deflate=None):
+        key = deflate and deflate.window_bits
+        frame = self._frames.get(key)
+        if frame is None:
+            if deflate:
+                frame = deflate.frame(self.payload)
+            else:
+                frame = create_binary_frame(self.payload, OPCODE_TEXT)
+            self._frames[key] = frame
+        return frame
+
 # Exceptions
 
 class ConnectionTerminatedException(Exception):
@@ -304,9 +459,16 @@ class InvalidFrameException(ConnectionTerminatedException):
 
     pass
 
+class InvalidUTF8Exception(InvalidFrameException):
+    """This exception will be raised when we receive a text frame which
+    contains invalid UTF-8 strings.
+    """
+
+    pass
+
 class BadOperationException(Exception):
     """This exception will be raised when send_message() is called on
-    server-terminated connection or receive_message() is called on
+    server-terminated connection or receive_messages() is called on
     client-terminated connection.
     """
 
@@ -315,18 +477,27 @@ class BadOperationException(Exception):
 class UnsupportedFrameException(Exception):
     """This exception will be raised when we receive a frame with flag, opcode
     we cannot handle. Handlers can just catch and ignore this exception and
-    call receive_message() again to continue processing the next frame.
+    call receive_messages() again to continue processing the next frame.
     """
 
     pass
 
 class wsclient:
+    """The server end of a websocket. The socket is non-blocking: frames
+    sent are queued and written as the socket takes them, see write().
+    deflate is the window_bits and context_takeover of permessage-deflate
+    to negotiate with the client (see negotiate_deflate()), or None for no
+    compression."""
 
-    def __init__(self, sock):
+    def __init__(self, sock, deflate=None):
         self._sock = sock
+        self._sock.setblocking(False)
+        self._out = deque()     # Frames not yet written, the first one maybe in part
+        self._out_offset = 0    # Bytes of the first frame written
+        self._out_bytes = 0     # Bytes not yet written
 
-        self._send_parts = []
-        self._recv_part = None
+        self._in = bytearray()  # Bytes read, not yet parsed from _in_pos on
+        self._in_pos = 0
         self.buffer_size = 65536
 
         # options
@@ -341,39 +512,89 @@ class wsclient:
         self._ping_queue = deque()
         self._client_terminated = False
         self._server_terminated = False
+        # Whether the message being received in fragments is deflated
+        self._original_deflated = False
+        # permessage-deflate options, then the PerMessageDeflate negotiated
+        self._deflate_options = deflate
+        self.deflate = None
+
+    def _fill(self):
+        """Read what the socket has, up to MAX_READ bytes, into the input
+        buffer. Return False when the client has closed the connection."""
+
+        read = 0
+        while read < MAX_READ:
+            try:
+                chunk = self._sock.recv(self.buffer_size)
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return True
+                raise
+            if not chunk:
+                return False
+            self._in += chunk
+            read += len(chunk)
+        return True
+
+    def _next_frame(self):
+        """Parse the next frame of the input buffer, or return None if it
+        hasn't all arrived yet.
 
-    def _receive_frame(self):
-        received = self._sock.recv(2)
+        Raises:
+            InvalidFrameException: when the frame header is invalid.
+        """
 
-        # Client close abruptly
-        if len(received) == 0:
-            return OPCODE_ABRUPT, [], 1, 0, 0, 0
+        buf = self._in
+        pos = self._in_pos
+        available = len(buf) - pos
+        if available < 2:
+            return None
 
-        first_byte = ord(received[0])
-        fin = (first_byte >> 7) & 1
-        rsv1 = (first_byte >> 6) & 1
-        rsv2 = (first_byte >> 5) & 1
-        rsv3 = (first_byte >> 4) & 1
+        first_byte = buf[pos]
+        second_byte = buf[pos + 1]
         opcode = first_byte & 0xf
-
-        second_byte = ord(received[1])
         mask = (second_byte >> 7) & 1
         payload_length = second_byte & 0x7f
+        header_length = 2
+        if payload_length == 126:
+            header_length = 4
+            if available < header_length:
+                return None
+            payload_length = struct.unpack_from('!H', buf, pos + 2)[0]
+        elif payload_length == 127:
+            header_length = 10
+            if available < header_length:
+                return None
+            payload_length = struct.unpack_from('!Q', buf, pos + 2)[0]
+            if payload_length >> 63:
+                raise InvalidFrameException(
+                    'MSB of 64-bit payload length must be 0')
+
+        # Check the constraint on the payload size for control frames
+        # before waiting for the payload.
+        # See also http://tools.ietf.org/html/rfc6455#section-5.5
+        if _is_control_opcode(opcode) and payload_length > 125:
+            raise InvalidFrameException(
+                'Payload data size of control frames must be 125 bytes or '
+                'less')
+        if (payload_length + sum(map(len, self._received_fragments)) >
+            MAX_MESSAGE_SIZE):
+            raise InvalidFrameException(
+                'Message is larger than %d bytes' % MAX_MESSAGE_SIZE)
 
         if mask == 1:
-            masking_nonce = self._sock.recv(4)
-            masker = RepeatedXorMasker(masking_nonce)
-        else:
-            masker = NoopMasker()
-        raw_payload_bytes = self._sock.recv(payload_length)
-        bytes = masker.mask(raw_payload_bytes)
+            header_length += 4
+        if available < header_length + payload_length:
+            return None
 
-        return opcode, bytes, fin, rsv1, rsv2, rsv3
-
-    def _receive_frame_as_frame_object(self):
-        opcode, bytes, fin, rsv1, rsv2, rsv3 = self._receive_frame()
+        bytes = str(buffer(buf, pos + header_length, payload_length))
+        if mask == 1:
+            masking_nonce = str(buffer(buf, pos + header_length - 4, 4))
+            bytes = RepeatedXorMasker(masking_nonce).mask(bytes)
+        self._in_pos = pos + header_length + payload_length
 
-        return Frame(fin=fin, rsv1=rsv1, rsv2=rsv2, rsv3=rsv3,
+        return Frame(fin=(first_byte >> 7) & 1, rsv1=(first_byte >> 6) & 1,
+                     rsv2=(first_byte >> 5) & 1, rsv3=(first_byte >> 4) & 1,
                      opcode=opcode, payload=bytes)
 
     def send_message(self, message, end=True, binary=False):
@@ -398,24 +619,96 @@ class wsclient:
                 'Message for binary frame must be instance of str')
 
         try:
-            self._sock.send(self._writer.build(message, end, binary))
+            self._queue(self._writer.build(message, end, binary))
         except ValueError, e:
             raise BadOperationException(e)
 
-    def receive_message(self):
-        """Receive a WebSocket frame and return its payload as a text in
-        unicode or a binary in str.
+    def send_frame(self, frame):
+        """Send a frame made by create_text_frame() or create_binary_frame(),
+        or a SharedTextFrame, deflated if negotiated with the client."""
+
+        if self._server_terminated:
+            raise BadOperationException(
+                'Requested send_frame after sending out a closing handshake')
+
+        if isinstance(frame, SharedTextFrame):
+            if self.deflate is None:
+                frame = frame.frame()
+            elif not self.deflate.context_takeover:
+                frame = frame.frame(self.deflate)
+            # else deflated by write(), in the order the client inflates
+        self._queue(frame)
+
+    def _queue(self, data):
+        self._out.append(data)
+        self._out_bytes += len(data)
+        self.write()
+
+    def write(self):
+        """Write queued frames, as much as the socket takes without blocking.
+        Return True if everything is written.
+
+        Raises:
+            socket.error: when the connection is broken.
+        """
+
+        out = self._out
+        while out:
+            if isinstance(out[0], SharedTextFrame):
+                frame = self.deflate.frame(out[0].payload)
+                self._out_bytes += len(frame) - len(out[0])
+                out[0] = frame
+            try:
+                sent = self._sock.send(buffer(out[0], self._out_offset))
+            except socket.error, e:
+                if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    return False
+                raise
+            self._out_bytes -= sent
+            self._out_offset += sent
+            if self._out_offset == len(out[0]):
+                out.popleft()
+                self._out_offset = 0
+        return True
+
+    def wants_write(self):
+        """Tell if there are frames waiting for the socket to take them."""
+        return bool(self._out)
+
+    def queued(self):
+        """Bytes waiting to be written."""
+        return self._out_bytes
+
+    def drop_oldest(self, limit):
+        """Drop the oldest frames not yet begun on, until at most limit bytes
+        are queued. Return the number of frames dropped."""
+
+        out = self._out
+        # With context takeover the first one may be deflated already
+        keep = self._out_offset or (self.deflate and self.deflate.context_takeover)
+        started = out.popleft() if keep and out else None
+        dropped = 0
+        while out and self._out_bytes > limit:
+            self._out_bytes -= len(out.popleft())
+            dropped += 1
+        if started is not None:
+            out.appendleft(started)
+        return dropped
+
+    def receive_messages(self):
+        """Read what the socket has, without blocking, and return the
+        messages completed by it, in order. Frames may arrive in any number
+        of reads, the rest of them is kept for the next call.
 
         Returns:
-            payload data of the frame
+            list of the payload data of the messages
             - as unicode instance if received text frame
             - as str instance if received binary frame
-            or None if received closing handshake.
+            - None if received closing handshake, or the client closed the
+              connection. It is the last one.
         Raises:
             BadOperationException: when called on a client-terminated
                 connection.
-            ConnectionTerminatedException: when read returns empty
-                string.
             InvalidFrameException: when the frame contains invalid
                 data.
             UnsupportedFrameException: when the received frame has
@@ -425,141 +718,152 @@ class wsclient:
 
         if self._client_terminated:
             raise BadOperationException(
-                'Requested receive_message after receiving a closing '
+                'Requested receive_messages after receiving a closing '
                 'handshake')
 
-        while True:
-            # mp_conn.read will block if no bytes are available.
-            # Timeout is controlled by TimeOut directive of Apache.
-
-            frame = self._receive_frame_as_frame_object()
-
-            # Check the constraint on the payload size for control frames
-            # before extension processes the frame.
-            # See also http://tools.ietf.org/html/rfc6455#section-5.5
-            if (_is_control_opcode(frame.opcode) and
-                len(frame.payload) > 125):
+        connected = self._fill()
+        messages = []
+        try:
+            while not self._client_terminated:
+                frame = self._next_frame()
+                if frame is None:
+                    break
+                message = self._receive_frame(frame)
+                if message is not _NO_MESSAGE:
+                    messages.append(message)
+        finally:
+            del self._in[:self._in_pos]
+            self._in_pos = 0
+        if not connected and not self._client_terminated:
+            self._client_terminated = True
+            messages.append(None)
+        return messages
+
+    def _receive_frame(self, frame):
+        """Handle a received frame, return the message it completes or
+        _NO_MESSAGE."""
+
+        # RSV1 marks the first frame of a deflated message
+        deflated = (frame.rsv1 and self.deflate is not None and
+                    frame.opcode in (OPCODE_TEXT, OPCODE_BINARY))
+        if (frame.rsv1 and not deflated) or frame.rsv2 or frame.rsv3:
+            raise UnsupportedFrameException(
+                'Unsupported flag is set (rsv = %d%d%d)' %
+                (frame.rsv1, frame.rsv2, frame.rsv3))
+
+        if _is_control_opcode(frame.opcode):
+            # Control frames may come in between the fragments of a message
+            # See also http://tools.ietf.org/html/rfc6455#section-5.4
+            if not frame.fin:
                 raise InvalidFrameException(
-                    'Payload data size of control frames must be 125 bytes or '
-                    'less')
-
-            if frame.rsv1 or frame.rsv2 or frame.rsv3:
-                raise UnsupportedFrameException(
-                    'Unsupported flag is set (rsv = %d%d%d)' %
-                    (frame.rsv1, frame.rsv2, frame.rsv3))
-
-            if frame.opcode == OPCODE_CONTINUATION:
-                if not self._received_fragments:
-                    if frame.fin:
-                        raise InvalidFrameException(
-                            'Received a termination frame but fragmentation '
-                            'not started')
-                    else:
-                        raise InvalidFrameException(
-                            'Received an intermediate frame but '
-                            'fragmentation not started')
-
+                    'Control frames must not be fragmented')
+            opcode = frame.opcode
+            message = frame.payload
+        elif frame.opcode == OPCODE_CONTINUATION:
+            if not self._received_fragments:
                 if frame.fin:
-                    # End of fragmentation frame
-                    self._received_fragments.append(frame.payload)
-                    message = ''.join(self._received_fragments)
-                    self._received_fragments = []
+                    raise InvalidFrameException(
+                        'Received a termination frame but fragmentation '
+                        'not started')
                 else:
-                    # Intermediate frame
-                    self._received_fragments.append(frame.payload)
-                    continue
-            else:
-                if self._received_fragments:
-                    if frame.fin:
-                        raise InvalidFrameException(
-                            'Received an unfragmented frame without '
-                            'terminating existing fragmentation')
-                    else:
-                        raise InvalidFrameException(
-                            'New fragmentation started without terminating '
-                            'existing fragmentation')
-
+                    raise InvalidFrameException(
+                        'Received an intermediate frame but '
+                        'fragmentation not started')
+
+            self._received_fragments.append(frame.payload)
+            if not frame.fin:
+                # Intermediate frame
+                return _NO_MESSAGE
+            # End of fragmentation frame
+            opcode = self._original_opcode
+            deflated = self._original_deflated
+            message = ''.join(self._received_fragments)
+            self._received_fragments = []
+        else:
+            if self._received_fragments:
                 if frame.fin:
-                    # Unfragmented frame
-
-                    self._original_opcode = frame.opcode
-                    message = frame.payload
+                    raise InvalidFrameException(
+                        'Received an unfragmented frame without '
+                        'terminating existing fragmentation')
                 else:
-                    # Start of fragmentation frame
-
-                    if _is_control_opcode(frame.opcode):
-                        raise InvalidFrameException(
-                            'Control frames must not be fragmented')
-
-                    self._original_opcode = frame.opcode
-                    self._received_fragments.append(frame.payload)
-                    continue
-
-            if self._original_opcode == OPCODE_TEXT:
-                # The WebSocket protocol section 4.4 specifies that invalid
-                # characters must be replaced with U+fffd REPLACEMENT
-                # CHARACTER.
-                try:
-                    return message.decode('utf-8')
-                except UnicodeDecodeError, e:
-                    raise InvalidUTF8Exception(e)
-            elif self._original_opcode == OPCODE_BINARY:
-                return message
-            elif self._original_opcode == OPCODE_ABRUPT:
-                self._client_terminated = True
-                return None
-            elif self._original_opcode == OPCODE_CLOSE:
-                self._client_terminated = True
-
-                # Status code is optional. We can have status reason only if we
-                # have status code. Status reason can be empty string. So,
-                # allowed cases are
-                # - no application data: no code no reason
-                # - 2 octet of application data: has code but no reason
-                # - 3 or more octet of application data: both code and reason
-                if len(message) == 0:
-                    self._ws_close_code = (
-                        STATUS_NO_STATUS_RECEIVED)
-                elif len(message) == 1:
                     raise InvalidFrameException(
-                        'If a close frame has status code, the length of '
-                        'status code must be 2 octet')
-                elif len(message) >= 2:
-                    self._ws_close_code = struct.unpack(
-                        '!H', message[0:2])[0]
-                    self._ws_close_reason = message[2:].decode(
-                        'utf-8', 'replace')
-
-                if self._server_terminated:
-                    return None
-
-                code = STATUS_NORMAL_CLOSURE
-                reason = ''
-                self._send_closing_handshake(code, reason)
+                        'New fragmentation started without terminating '
+                        'existing fragmentation')
+
+            self._original_opcode = opcode = frame.opcode
+            self._original_deflated = deflated
+            if not frame.fin:
+                # Start of fragmentation frame
+                self._received_fragments.append(frame.payload)
+                return _NO_MESSAGE
+            # Unfragmented frame
+            message = frame.payload
+
+        if deflated:
+            message = self.deflate.inflate(message)
+        if opcode == OPCODE_TEXT:
+            # The WebSocket protocol section 4.4 specifies that invalid
+            # characters must be replaced with U+fffd REPLACEMENT
+            # CHARACTER.
+            try:
+                return message.decode('utf-8')
+            except UnicodeDecodeError, e:
+                raise InvalidUTF8Exception(e)
+        elif opcode == OPCODE_BINARY:
+            return message
+        elif opcode == OPCODE_CLOSE:
+            self._client_terminated = True
+
+            # Status code is optional. We can have status reason only if we
+            # have status code. Status reason can be empty string. So,
+            # allowed cases are
+            # - no application data: no code no reason
+            # - 2 octet of application data: has code but no reason
+            # - 3 or more octet of application data: both code and reason
+            if len(message) == 0:
+                self._ws_close_code = (
+                    STATUS_NO_STATUS_RECEIVED)
+            elif len(message) == 1:
+                raise InvalidFrameException(
+                    'If a close frame has status code, the length of '
+                    'status code must be 2 octet')
+            elif len(message) >= 2:
+                self._ws_close_code = struct.unpack(
+                    '!H', message[0:2])[0]
+                self._ws_close_reason = message[2:].decode(
+                    'utf-8', 'replace')
+
+            if self._server_terminated:
                 return None
-            elif self._original_opcode == OPCODE_PING:
-                self._send_pong(message)
-            elif self._original_opcode == OPCODE_PONG:
-                inflight_pings = deque()
-
-                while True:
-                    try:
-                        expected_body = self._ping_queue.popleft()
-                        if expected_body == message:
-                            # inflight_pings contains pings ignored by the
-                            # other peer. Just forget them.
-                            break
-                        else:
-                            inflight_pings.append(expected_body)
-                    except IndexError, e:
-                        # The received pong was unsolicited pong. Keep the
-                        # ping queue as is.
-                        self._ping_queue = inflight_pings
+
+            code = STATUS_NORMAL_CLOSURE
+            reason = ''
+            self._send_closing_handshake(code, reason)
+            return None
+        elif opcode == OPCODE_PING:
+            self._send_pong(message)
+            return _NO_MESSAGE
+        elif opcode == OPCODE_PONG:
+            inflight_pings = deque()
+
+            while True:
+                try:
+                    expected_body = self._ping_queue.popleft()
+                    if expected_body == message:
+                        # inflight_pings contains pings ignored by the
+                        # other peer. Just forget them.
                         break
-                continue
-            else:
-                raise UnsupportedFrameException(
-                    'Opcode %d is not supported' % self._original_opcode)
+                    else:
+                        inflight_pings.append(expected_body)
+                except IndexError, e:
+                    # The received pong was unsolicited pong. Keep the
+                    # ping queue as is.
+                    self._ping_queue = inflight_pings
+                    break
+            return _NO_MESSAGE
+        else:
+            raise UnsupportedFrameException(
+                'Opcode %d is not supported' % opcode)
 
     def _send_closing_handshake(self, code, reason):
         body = ''
@@ -577,11 +881,11 @@ class wsclient:
 
         frame = create_close_frame(
             body,
-            self._mask_send)
+            self.mask_send)
 
         self._server_terminated = True
 
-        self._sock.send(frame)
+        self._queue(frame)
 
     def send_close(self, code=STATUS_NORMAL_CLOSURE, reason=''):
         """Closes a WebSocket connection.
@@ -609,23 +913,8 @@ class wsclient:
                     'close reason must be an instance of str or unicode')
 
         self._send_closing_handshake(code, reason)
-
-        if (code == STATUS_GOING_AWAY or
-            code == STATUS_PROTOCOL_ERROR):
-            # It doesn't make sense to wait for a close frame if the reason is
-            # protocol error or that the server is going away. For some of
-            # other reasons, it might not make sense to wait for a close frame,
-            # but it's not clear, yet.
-            return
-
-        # For now, we expect receiving closing handshake right after sending
-        # out closing handshake.
-        message = self.receive_message()
-        if message is not None:
-            raise ConnectionTerminatedException(
-                'Didn\'t receive valid ack for closing handshake')
-
-        self._sock.close()
+        # The client's closing handshake is returned by receive_messages(),
+        # as None, when it arrives.
 
     def close(self):
         self._sock.close()
@@ -633,27 +922,55 @@ class wsclient:
     def send_ping(self, body=''):
         frame = create_ping_frame(
             body,
-            self._mask_send)
-        self._sock.send(frame)
+            self.mask_send)
+        self._queue(frame)
 
         self._ping_queue.append(body)
 
     def _send_pong(self, body):
         frame = create_pong_frame(
             body,
-            self._options.mask_send)
-        self._sock.send(frame)
+            self.mask_send)
+        self._queue(frame)
 
     def do_handshake(self):
-        request = self._sock.recv(1024)
+        """Read the opening handshake and queue the response. Return False
+        while the request hasn't all arrived.
+
+        Raises:
+            ConnectionTerminatedException: when the client closes the
+                connection or the request is not a websocket handshake.
+        """
+
+        if not self._fill():
+            raise ConnectionTerminatedException('Closed during the handshake')
+        end = self._in.find('\r\n\r\n')
+        if end < 0:
+            if len(self._in) > MAX_HANDSHAKE_SIZE:
+                raise ConnectionTerminatedException('Handshake too large')
+            return False
+        # Frames sent right after the request stay in the buffer
+        request = str(self._in[:end + 2])
+        del self._in[:end + 4]
         # print("[Weblink] Received handshake:", request)
         request_line, header_lines = request.split('\r\n', 1)
         headers = Message(StringIO(header_lines))
         key = headers['Sec-WebSocket-Key']
+        if key is None:
+            raise ConnectionTerminatedException(
+                'Not a websocket handshake: %s' % request_line)
+
+        extensions = ''
+        if self._deflate_options is not None:
+            self.deflate, accepted = negotiate_deflate(
+                ','.join(headers.getheaders('Sec-WebSocket-Extensions')),
+                **self._deflate_options)
+            if accepted:
+                extensions = 'Sec-WebSocket-Extensions: %s\r\n' % accepted
 
         # Generate the hash value for the accept header
         accept = b64encode(sha1(key + MAGICAL_STRING).digest())
-        response = HANDSHAKE_RESPONSE_RFC6455 % accept
+        response = HANDSHAKE_RESPONSE_RFC6455 % (accept, extensions)
         # print("[Weblink] Completed handshake:", response)
-        self._sock.send(response)
-        return
+        self._queue(response)
+        return True
@@ -14,71 +14,332 @@
 #
 ########################################################################
 
+"""The link between the Core and the browsers (web/scripts/weblink.js).
+
+A browser gets the replies to its own requests, and the updates it subscribes
+to by sending
+    {"dest": "urn:weblink", "action": "set", "key": "subscribe", "value": filters}
+where filters is a list of {"urn": pattern, "key": pattern, "action": pattern},
+patterns as in fnmatch, any of them left out matches anything. A message is
+sent to the browser if it matches any of the filters, e.g.
+    [{"urn": "urn:hodcp:node:1*"}, {"urn": "urn:logger", "key": "log_append"}]
+gets updates of nodes 1, 10, 11 ... and pushed log events. Until it subscribes,
+or after subscribing to null, a browser gets every message.
+
+Updates of state (e.g. by accessors.set()) are coalesced: only the latest value
+of each urn and key is kept, and sent update_rate times a second, several in one
+message {"sender": "urn:weblink", "key": "batch", "value": [update, ...]}. The rate
+is set by "weblink": {"update_rate": 20} in the simulation config, or by sending
+'set update_rate' to urn:weblink, 0 sends every update as it comes. Replies and
+events (pushed log events) are always sent at once.
+
+Browsers are written to without blocking, so a slow one holds up no one else.
+What a browser doesn't take at once is queued, up to "max_queue" bytes. Then
+the "overflow" policy of the config applies:
+    collapse    -- hold back updates of state, the latest value of each, until
+                   the queue is written, drop the oldest messages if still too much
+    drop_oldest -- drop the oldest messages
+    disconnect  -- close the connection, the browser may reconnect
+e.g. "weblink": {"update_rate": 20, "max_queue": 1048576, "overflow": "collapse"}
+
+Messages are compressed with permessage-deflate (RFC 7692) for the browsers
+that offer it, as browsers do. It is set by "deflate" in the config:
+    true                    -- the defaults, as below
+    {"window_bits": 15,     -- 9 to 15, a smaller window takes less memory
+                               per browser and compresses less
+     "context_takeover": true}
+                            -- each message is compressed in the context of
+                               those before it, which compresses small ones
+                               far better, but they are compressed for each
+                               browser rather than once for all of them
+    false                   -- no compression
+"""
+
+import collections
+import fnmatch
+import re
 import socket
-import select
+import time
 import web_socket
 import json
+import poller
+
+URN = 'urn:weblink'
+
+# Batches of updates per second, by default
+UPDATE_RATE = 20
+# Bytes queued for a browser before the overflow policy applies, by default
+MAX_QUEUE = 1024 * 1024
+OVERFLOW_POLICIES = ('collapse', 'drop_oldest', 'disconnect')
+# permessage-deflate, by default, for the browsers that offer it
+DEFLATE = {'window_bits': 15, 'context_takeover': True}
+
+# Keys of messages that are events, each of which matters, rather than a state
+EVENT_KEYS = ('log', 'log_append')
 
-def create_weblink(port, ctrl):
-    host = ''
-    backlog = 5
-    size = 512
-
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
-    server.bind((host,port))
-    server.listen(backlog)
-
-    # Track input sources
-    inputs = [ctrl, server]
-    clients = {}
-    handshake_needed = None
-
-    running = 1
-    while running:
-        inputready, outputready, exceptready = select.select(inputs,[],[])
-
-        for s in inputready:
-
-            if s == server:
-                # handle the server (listening) socket
-                sock, address = server.accept()
-                # print "[Weblink] Accepted:", (sock, address)
-                inputs.append(sock)
-                clients[sock] = web_socket.wsclient(sock)
-                handshake_needed = sock
-
-            elif s == ctrl:
-                # Control channel message from core
-                msg = s.recv()
-
-                if msg['action'] == 'set' and msg['key'] == 'running' and msg['value'] == False:
-                    running = 0
-
-                else:
-                    # FIXME: This is broken - don't send to ALL!
-                    # print "\033[34m[Weblink] FIXME: ctrl msg dispatch \033[0m"
-                    for c in clients.values():
-                        # Encode message and pass on to browser
-                        # print "[Weblink:page] >>> "+json.dumps(msg)
-                        c.send_message(json.dumps(msg))
+_FILTER_KEYS = (('urn', 'sender'), ('key', 'key'), ('action', 'action'))
 
+def subscription(filters):
+    """Return a test of the messages that pass filters (see above)."""
+    if filters is None:
+        return lambda msg: True
+    if not isinstance(filters, list) or not all(isinstance(f, dict) for f in filters):
+        raise ValueError('Bad subscription %s, expected a list of filters' % filters)
+    tests = []
+    for f in filters:
+        for name, field in _FILTER_KEYS:
+            if f.get(name) is not None and not isinstance(f[name], basestring):
+                raise ValueError('Bad subscription %s, %s must be a string' % (filters, name))
+        tests.append([(field, re.compile(fnmatch.translate(f[name])).match)
+                      for name, field in _FILTER_KEYS if f.get(name) not in (None, '*')])
+
+    def passes(msg):
+        for test in tests:
+            for field, match in test:
+                if not match(unicode(msg.get(field, ''))):
+                    break
             else:
-                # handle all other sockets
-                client = clients[s]
-                if handshake_needed == s:
-                    client.do_handshake()
-                    handshake_needed = None
-                else:
-                    msg = client.receive_message()
-                    if not msg:
-                        print "[Weblink] \033[31m client termination \033[0m"
-                        client.close()
-                        # Remove references to this client
-                        del clients[s]
-                        inputs.remove(s)
-                    else:
-                        # print "[Weblink:page] <<< "+msg
-                        # Decode and pass to core for dispatch
-                        ctrl.send(json.loads(msg))
-    server.close()
+                return True
+        return False
+    return passes
+
+_everything = subscription(None)
+
+def _about(msg):
+    return (msg.get('sender'), msg['key'])
+
+def _batch_message(updates):
+    if len(updates) == 1:
+        return updates[0]
+    return {'dest':URN, 'sender':URN, 'action':'set', 'key':'batch', 'value':updates}
+
+class Browser:
+    """A connected browser."""
+
+    def __init__(self, sock, deflate):
+        self.sock = sock
+        self.ws = web_socket.wsclient(sock, deflate)
+        self.handshake_done = False
+        self.passes = _everything     # Test of the messages it subscribes to
+        self.held = collections.OrderedDict()   # (urn, key) -> latest update held back
+        self.dropped = 0              # Messages dropped by the overflow policy
+
+class WebLink:
+
+    def __init__(self, port, config, ctrl):
+        self.ctrl = ctrl
+        self.update_rate = config.get('update_rate', UPDATE_RATE)
+        self.max_queue = config.get('max_queue', MAX_QUEUE)
+        self.overflow = config.get('overflow', 'collapse')
+        if self.overflow not in OVERFLOW_POLICIES:
+            print "[Weblink] Unknown overflow policy '%s', using 'collapse'" % self.overflow
+            self.overflow = 'collapse'
+        self.deflate = self.deflate_options(config.get('deflate', True))
+
+        host = ''
+        backlog = 5
+        self.server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.server.setsockopt(socket.SOL_SOCKET,socket.SO_REUSEADDR,1)
+        self.server.bind((host,port))
+        self.server.listen(backlog)
+
+        # Track input sources
+        self.inputs = poller.Poller()
+        self.inputs.register(ctrl)
+        self.inputs.register(self.server)
+        self.browsers = {}      # socket -> Browser
+        self.pending = {}       # (urn, key) -> sockets of the browsers waiting for the reply to a get
+        self.updates = collections.OrderedDict()   # (urn, key) -> latest update not yet sent
+        self.last_batch = 0
+
+    def deflate_options(self, deflate):
+        """Options of permessage-deflate from the config: true for the
+        defaults, some of them to change, or false for no compression."""
+        if not deflate:
+            return None
+        options = dict(DEFLATE)
+        if isinstance(deflate, dict):
+            options.update((key, deflate[key]) for key in DEFLATE if key in deflate)
+        if options['window_bits'] not in range(9, 16):
+            print "[Weblink] Bad deflate window_bits %s, using 15" % options['window_bits']
+            options['window_bits'] = 15
+        options['context_takeover'] = bool(options['context_takeover'])
+        return options
+
+    def serve(self):
+        running = True
+        while running:
+            timeout = None
+            if self.updates and self.update_rate:
+                timeout = max(0, self.last_batch + 1.0 / self.update_rate - time.time())
+            for s, events in self.inputs.poll(timeout):
+                if s == self.server:
+                    # handle the server (listening) socket
+                    sock, address = self.server.accept()
+                    # print "[Weblink] Accepted:", (sock, address)
+                    self.inputs.register(sock)
+                    self.browsers[sock] = Browser(sock, self.deflate)
+                elif s == self.ctrl:
+                    # Control channel message from core
+                    running = self.control_message(s.recv())
+                elif s in self.browsers:
+                    if events & poller.WRITE:
+                        self.write(self.browsers[s])
+                    if events & poller.READ and s in self.browsers:
+                        self.receive(self.browsers[s])
+
+            if self.updates and (not self.update_rate or time.time() >= self.last_batch + 1.0 / self.update_rate):
+                self.send_batch(self.updates.values())
+                self.updates.clear()
+                self.last_batch = time.time()
+        self.server.close()
+
+    def control_message(self, msg):
+        """Pass msg on to the browsers, return False when it is time to stop."""
+        if msg['action'] == 'set' and msg['key'] == 'running' and msg['value'] == False:
+            return False
+        # Replies go to those who asked (and the subscribers) at once
+        about = _about(msg)
+        waiting = self.pending.pop(about, None)
+        if waiting is None and self.update_rate and msg['key'] not in EVENT_KEYS:
+            self.updates[about] = msg
+            return True
+        if about in self.updates:
+            # Don't follow up with an older value
+            self.updates[about] = msg
+        dest = [b for s, b in self.browsers.items() if s in (waiting or ()) or b.passes(msg)]
+        if dest:
+            # Encode message once and pass on to browsers
+            # print "[Weblink:page] >>> "+json.dumps(msg)
+            frame = web_socket.SharedTextFrame(json.dumps(msg))
+            state = waiting is None and msg['key'] not in EVENT_KEYS
+            for browser in dest:
+                self.send(browser, frame, [msg] if state else ())
+        return True
+
+    def send_batch(self, updates):
+        """Send each browser the updates it subscribes to, in one message.
+        Browsers getting the same updates share the encoded message."""
+        frames = {}
+        for browser in self.browsers.values():
+            wanted = tuple(i for i, msg in enumerate(updates) if browser.passes(msg))
+            if not wanted:
+                continue
+            frame = frames.get(wanted)
+            if frame is None:
+                msg = _batch_message([updates[i] for i in wanted])
+                frame = frames[wanted] = web_socket.SharedTextFrame(json.dumps(msg))
+            self.send(browser, frame, [updates[i] for i in wanted])
+
+    def send(self, browser, frame, updates=()):
+        """Queue frame for browser, where updates are the updates of state
+        it carries, if any, and apply the overflow policy."""
+        ws = browser.ws
+        if not browser.handshake_done:
+            return
+        if updates and self.overflow == 'collapse' and (browser.held or ws.queued() + len(frame) > self.max_queue):
+            # Behind already, keep the latest values for when the browser has caught up
+            for msg in updates:
+                browser.held[_about(msg)] = msg
+            self.watch(browser)
+            return
+        try:
+            ws.send_frame(frame)
+        except (socket.error, web_socket.BadOperationException), e:
+            self.close(browser, e)
+            return
+        if ws.queued() > self.max_queue:
+            if self.overflow == 'disconnect':
+                self.close(browser, 'more than %d bytes behind' % self.max_queue)
+                return
+            browser.dropped += ws.drop_oldest(self.max_queue)
+        self.watch(browser)
+
+    def write(self, browser):
+        """Write to a browser that is ready for it, then send what was held back."""
+        try:
+            done = browser.ws.write()
+        except socket.error, e:
+            self.close(browser, e)
+            return
+        if done and browser.held:
+            held = browser.held.values()
+            browser.held.clear()
+            msg = _batch_message(held)
+            self.send(browser, web_socket.SharedTextFrame(json.dumps(msg)), held)
+        else:
+            self.watch(browser)
+
+    def watch(self, browser):
+        # Wait for the socket to take more, as long as something is queued or held back
+        events = poller.READ
+        if browser.ws.wants_write() or browser.held:
+            events |= poller.WRITE
+        self.inputs.modify(browser.sock, events)
+
+    def receive(self, browser):
+        ws = browser.ws
+        sock = browser.sock
+        try:
+            if not browser.handshake_done:
+                browser.handshake_done = ws.do_handshake()
+                if not browser.handshake_done:
+                    return
+                self.watch(browser)
+            msgs = ws.receive_messages()
+        except (socket.error, web_socket.ConnectionTerminatedException,
+                web_socket.BadOperationException, web_socket.UnsupportedFrameException), e:
+            self.close(browser, e)
+            return
+        for msg in msgs:
+            if msg is None:
+                self.close(browser)
+                return
+            # print "[Weblink:page] <<< "+msg
+            # Decode and pass to core for dispatch
+            try:
+                msg = json.loads(msg)
+            except ValueError:
+                msg = None
+            if not isinstance(msg, dict):
+                print "[Weblink] Bad message from client"
+                continue
+            if msg.get('dest') == URN:
+                self.set(browser, msg.get('key'), msg.get('value'))
+                continue
+            if msg.get('action') == 'get':
+                self.pending.setdefault((msg.get('dest'), msg.get('key')), set()).add(sock)
+            self.ctrl.send(msg)
+
+    def set(self, browser, key, value):
+        """Handle a message from a browser to the weblink itself."""
+        if key == 'subscribe':
+            try:
+                browser.passes = subscription(value)
+            except ValueError, e:
+                print "[Weblink] %s" % e
+        elif key == 'update_rate':
+            try:
+                self.update_rate = max(0.0, float(value or 0))
+            except (TypeError, ValueError):
+                print "[Weblink] Bad update rate %s" % value
+        else:
+            print "[Weblink] Unknown key '%s'" % key
+
+    def close(self, browser, reason=None):
+        sock = browser.sock
+        if reason:
+            print "[Weblink] \033[31m client termination (%s) \033[0m" % reason
+        else:
+            print "[Weblink] \033[31m client termination \033[0m"
+        if browser.dropped:
+            print "[Weblink] %d messages to the client were dropped" % browser.dropped
+        # Remove references to this client
+        self.inputs.unregister(sock)
+        del self.browsers[sock]
+        for waiting in self.pending.values():
+            waiting.discard(sock)
+        browser.ws.close()
+
+def create_weblink(port, config, ctrl):
+    WebLink(port, config, ctrl).serve()
@@ -17,8 +17,8 @@
 from parrot.core import core
 
 
-def run(config_file, debug=False):
-    c = core.Core()
+def run(config_file, debug=False, host=None):
+    c = core.Core(host)
 
     try:
         c.setup_platform(config_file)
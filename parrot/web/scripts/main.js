@@ -13,11 +13,30 @@
 
 var APP = {};
 
+// Show only the nodes matching ?nodes=<pattern> (wildcards as in fnmatch),
+// e.g. ?nodes=urn:hodcp:node:1*, and get updates of those nodes only
+APP.nodes = query_param("nodes");
+
 window.onload = function () {
-    APP.weblink = new WebLink(incomingParrotMessage);
+    var subscription;
+    if (APP.nodes) {
+        subscription = [{urn: APP.nodes}, {urn: "urn:backplane"}, {urn: "urn:logger"}];
+    }
+    APP.weblink = new WebLink(incomingParrotMessage, subscription);
     setup_log();
 };
 
+function query_param(name) {
+    var match = new RegExp("[?&]" + name + "=([^&]*)").exec(window.location.search);
+    return match ? decodeURIComponent(match[1]) : null;
+}
+
+// A RegExp matching what the fnmatch pattern does
+function glob(pattern) {
+    var re = pattern.replace(/[.+^${}()|\\\/]/g, "\\$&").replace(/\*/g, ".*").replace(/\?/g, ".");
+    return new RegExp("^" + re + "$");
+}
+
 /*
  * Functions for reading and writing property values
  *
@@ -113,6 +132,9 @@ function setEditor(valueNode, buttonNode, nodeName, propertyName, propertyType)
  * Logger code
  */
 
+// Show at most this many log events, newest first
+var LOG_LIMIT = 1000;
+
 function setup_log()
 {
   var div = document.getElementById("log_button");
@@ -120,12 +142,14 @@ function setup_log()
 <form id="filter_id">\
 <label for="urn">URN:</label>\
 <input type="text" name="urn" text="URN">\
-<label for="time">Time:</label>\
+<label for="time">Last (s):</label>\
 <input type="text" name="time">\
 <label for="cat">Category:</label>\
 <input type="text" name="cat">\
 <label for="msg">Message:</label>\
 <input type="text" name="msg">\
+<label for="words">Words:</label>\
+<input type="checkbox" name="words">\
 <input type="button" value="Refresh" onclick="generate_log()">\
 </form>';
 }
@@ -134,10 +158,26 @@ function setup_log()
 function generate_log()
 {
     var form = document.getElementById("filter_id");
-    var params = [form["urn"].value, form["cat"].value, form["time"].value, form["msg"].value];
-    
+    // Match parts of urn and category, see Logger.getlog()
+    var params = {order:"desc", limit:LOG_LIMIT};
+    if (form["urn"].value) {
+        params.urn_like = "%" + form["urn"].value + "%";
+    }
+    if (form["cat"].value) {
+        params.category_like = "%" + form["cat"].value + "%";
+    }
+    if (form["msg"].value && form["words"].checked) {
+        // Full-text search, needs "logger": {"fulltext": true} in the config
+        params.match = form["msg"].value;
+    } else if (form["msg"].value) {
+        params.msg = form["msg"].value;
+    }
+    if (form["time"].value) {
+        params.since = Date.now() - 1000 * parseFloat(form["time"].value);
+    }
+
     var request = {
-        dest:"urn:hodcp:core",
+        dest:"urn:logger",
         sender:"urn:weblink",
         action:"set",
         key:"log_filter",
@@ -145,11 +185,27 @@ function generate_log()
     };
     APP.weblink.send(request);
     getLogs();
+
+    // Then have new events matching the filter pushed as they are logged
+    var filter = {};
+    for (var key in params) {
+        if (key != "order" && key != "limit") {
+            filter[key] = params[key];
+        }
+    }
+    request = {
+        dest:"urn:logger",
+        sender:"urn:weblink",
+        action:"set",
+        key:"log_subscribe",
+        value:filter,
+    };
+    APP.weblink.send(request);
 }
  
 function getLogs() {
     var request = {
-        dest:"urn:hodcp:core",
+        dest:"urn:logger",
         sender:"urn:weblink",
         action:"get",
         key:"log",
@@ -158,6 +214,31 @@ function getLogs() {
 }
 
 function set_logs(logs) {
+    APP.logs = logs;
+    show_logs();
+}
+
+// Add pushed events (oldest first) on top, skipping those already shown
+function append_logs(events) {
+    if (!APP.logs) {
+        return;
+    }
+    var last = APP.logs.length ? APP.logs[0].id : -1;
+    var added = false;
+    for (var i = 0; i < events.length; i++) {
+        if (events[i].id > last) {
+            APP.logs.unshift(events[i]);
+            added = true;
+        }
+    }
+    if (added) {
+        APP.logs.length = Math.min(APP.logs.length, LOG_LIMIT);
+        show_logs();
+    }
+}
+
+function show_logs() {
+    var logs = APP.logs;
     // Convert to HTML table
     log = '<table border="1"><th>Timestamp</th><th>Urn</th><th>Category</th><th>Msg</th>';
     for (var i = 0; i < logs.length; i++) {
@@ -184,6 +265,8 @@ function incomingParrotMessage(object) {
     } else if (object.key == "log") {
         // FIXME dunno, what should we do with this?
     set_logs(object.value);
+    } else if (object.key == "log_append") {
+        append_logs(object.value);
     } else {
         setProperty(object.sender, object.key, object.value);
     }
@@ -192,6 +275,10 @@ function incomingParrotMessage(object) {
 function setConfiguration(configData) {
     document.getElementById("description").innerHTML = configData["description"];
     var items = Object.keys(configData["nodes"]);
+    if (APP.nodes) {
+        var shown = glob(APP.nodes);
+        items = items.filter(function(urn) { return shown.test(urn); });
+    }
     // Add backplane to list of nodes
     items.push('urn:backplane');
     for (var i = 0; i < items.length; i++) {
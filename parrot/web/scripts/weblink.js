@@ -11,11 +11,26 @@
  *
  ***********************************************************************/
 
-var WebLink = function(recv_cb) {
+// subscription: the updates to get, see parrot/core/weblink.py (default all)
+var WebLink = function(recv_cb, subscription) {
 
     var ws = new WebSocket("ws://localhost:1112", "base64");
 
+    var subscribe = function(filters) {
+        var request = {
+            dest:"urn:weblink",
+            sender:"urn:weblink",
+            action:"set",
+            key:"subscribe",
+            value:filters,
+        };
+        ws.send(JSON.stringify(request));
+    };
+
     ws.onopen = function(e) {
+        if (subscription !== undefined) {
+            subscribe(subscription);
+        }
         var request = {
             dest:"urn:hodcp:core",
             sender:"urn:weblink",
@@ -27,7 +42,14 @@ var WebLink = function(recv_cb) {
 
     ws.onmessage = function (e) {
         var object = JSON.parse(e.data);
-        recv_cb(object);
+        if (object.sender == "urn:weblink" && object.key == "batch") {
+            // Latest values of several properties, see parrot/core/weblink.py
+            for (var i = 0; i < object.value.length; i++) {
+                recv_cb(object.value[i]);
+            }
+        } else {
+            recv_cb(object);
+        }
     }
 
     ws.onclose = function() {
@@ -38,5 +60,7 @@ var WebLink = function(recv_cb) {
         ws.send(JSON.stringify(object));
     };
 
+    this.subscribe = subscribe;
+
     return this;
 };